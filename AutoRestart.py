@@ -5,9 +5,8 @@ import sys
 import time
 
 carat_file = "Carat.py"
-utility_file = "utility.py"
 carat_update_file = "Carat_UPDATE.py"
-utility_update_file = "utility_UPDATE.py"
+update_suffix = "_UPDATE.py"
 
 bot_process = None
 
@@ -20,14 +19,11 @@ def terminate_bot():
 
 
 def ensure_newest():
-    # check whether update files for Carat.py/utility.py exist, if they do, replace old files
-    if os.path.exists(carat_update_file) and os.path.exists(utility_update_file):
-        if os.path.exists(carat_file):
-            os.remove(carat_file)
-        os.rename(carat_update_file, carat_file)
-        if os.path.exists(utility_file):
-            os.remove(utility_file)
-        os.rename(utility_update_file, utility_file)
+    # check whether update files exist, if they do, replace old files. Carat.py is downloaded last, so its update
+    # file existing means all the others are complete
+    if os.path.exists(carat_update_file):
+        for update_file in [file for file in os.listdir(".") if file.endswith(update_suffix)]:
+            os.replace(update_file, update_file[:-len(update_suffix)] + ".py")
 
 
 def main():
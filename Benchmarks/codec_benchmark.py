@@ -0,0 +1,57 @@
+# Times encoding and decoding a town square with 20 players and 30 nominations.
+# Run from the repository root: python Benchmarks/codec_benchmark.py
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+from Cogs.Townsquare import TownSquare, Player, Nomination, Vote
+
+Players = 20
+Nominations = 30
+Repetitions = 200
+
+
+def build_town_square() -> TownSquare:
+    players = [Player(100000000000000000 + i, f"Player {i}") for i in range(Players)]
+    nominations = []
+    for i in range(Nominations):
+        votes = {player.id: Vote("yes" if (i + j) % 2 else "no", bureaucrat=j == 3, thief=j == 7)
+                 for j, player in enumerate(players)}
+        nominations.append(Nomination(players[i % Players], players[(i + 1) % Players], votes, 1700000000,
+                                      {players[0].id: "yes"}, message=200000000000000000 + i, finished=i < 25))
+    return TownSquare(players, players[:1], nominations, 1, 2)
+
+
+def report(name: str, seconds: float):
+    print(f"{name:<40}{seconds / Repetitions * 1000:8.3f} ms")
+
+
+def main():
+    town_square = build_town_square()
+    data = town_square.to_dict()
+    text = codec.dumps(data)
+    print(f"{Players} players, {Nominations} nominations, {len(text)} bytes, "
+          f"orjson {'available' if codec.orjson is not None else 'not installed'}")
+    report("codec to_dict", timeit.timeit(town_square.to_dict, number=Repetitions))
+    report("codec from_dict", timeit.timeit(lambda: TownSquare.from_dict(data), number=Repetitions))
+    report("codec dumps", timeit.timeit(lambda: codec.dumps(data), number=Repetitions))
+    report("codec loads", timeit.timeit(lambda: codec.loads(text), number=Repetitions))
+    report("json dumps", timeit.timeit(lambda: json.dumps(data), number=Repetitions))
+    report("json loads", timeit.timeit(lambda: json.loads(text), number=Repetitions))
+    try:
+        # the functions behind dataclasses_json's to_dict/from_dict, for comparison with the previous implementation
+        from dataclasses_json.core import _asdict, _decode_dataclass
+    except ImportError:
+        print("dataclasses_json not installed, skipping comparison")
+        return
+    report("dataclasses_json to_dict", timeit.timeit(lambda: _asdict(town_square, False), number=Repetitions))
+    report("dataclasses_json from_dict",
+           timeit.timeit(lambda: _decode_dataclass(TownSquare, data, False), number=Repetitions))
+
+
+if __name__ == "__main__":
+    main()
@@ -3,7 +3,7 @@ import logging
 import os
 import sys
 import traceback
-from typing import Optional, List
+from typing import Optional, List, Dict
 
 import nextcord
 import requests
@@ -11,9 +11,14 @@ from dotenv import load_dotenv
 from nextcord.ext import commands
 from nextcord.ext.commands import DefaultHelpCommand, CommandError
 
+import database
+import persistence
+import scheduling
 import utility
 
 LogFile = "Carat.log"
+# everything outside the Cogs directory that Carat needs to run, see ReloadMainFiles
+MainFiles = ["Carat.py", "utility.py", "persistence.py", "codec.py", "database.py", "scheduling.py"]
 repository_api_url = "https://api.github.com/repos/JackKBroome/Carat_BOTC"
 
 LogLevelMapping = {'DEBUG': logging.DEBUG,
@@ -29,6 +34,7 @@ logging.basicConfig(filename=LogFile, filemode="w",
 try:
     load_dotenv()
     token = os.environ['TOKEN']
+    config = utility.get_config()
 except Exception as e:
     message = "Encountered an issue loading environment variables. Ensure .env file exists and is properly formatted " \
               "with all necessary variables.\nException: " + str(e)
@@ -41,13 +47,44 @@ allowedMentions = nextcord.AllowedMentions.all()
 allowedMentions.everyone = False
 help_command = DefaultHelpCommand(verify_checks=False, dm_help=None, dm_help_threshold=600)
 
-bot = commands.Bot(command_prefix=">",
-                   case_insensitive=True,
-                   intents=intents,
-                   allowed_mentions=allowedMentions,
-                   activity=nextcord.Game(">HelpMe or >help"),
-                   help_command=help_command,
-                   owner_id=utility.OwnerID)
+
+class Carat(commands.Bot):
+    persistence: persistence.Persistence
+    timers: scheduling.TimerService
+    helper: Optional[utility.Helper]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        backend = None
+        if config.storage_backend == 'sqlite':
+            backend = database.SqliteBackend(os.path.join(config.storage_location, "carat.sqlite3"))
+        self.persistence = persistence.Persistence(config.storage_write_delay, backend)
+        self.timers = scheduling.TimerService(self.persistence, os.path.join(config.storage_location, "timers.json"))
+        self.helper = None
+
+    async def close(self):
+        self.timers.stop()
+        # send out anything cogs are still collecting, then write storage changes still waiting to be coalesced
+        for cog in list(self.cogs.values()):
+            flush = getattr(cog, "flush", None)
+            if flush is not None:
+                try:
+                    await flush()
+                except Exception as e:
+                    logging.exception(f"Failed to flush {cog.qualified_name} on shutdown: {e}")
+        if self.helper is not None:
+            await self.helper.Audit.flush()
+        await self.persistence.close()
+        await super().close()
+
+
+bot = Carat(command_prefix=">",
+            case_insensitive=True,
+            intents=intents,
+            allowed_mentions=allowedMentions,
+            activity=nextcord.Game(">HelpMe or >help"),
+            help_command=help_command,
+            owner_id=utility.OwnerID)
 
 
 # load cogs and print ready message
@@ -56,14 +93,38 @@ async def on_ready():
     print('Logged in as')
     print(bot.user.name)
     print(bot.user.id)
+    # one helper is shared by all cogs; on a reconnect it picks up the new guild objects
+    import_storage = False
+    if bot.helper is None:
+        bot.helper = utility.Helper(bot, config)
+        # a new database starts out with what was stored as JSON files so far - checked before the cogs store anything
+        import_storage = isinstance(bot.persistence.backend, database.SqliteBackend) and \
+            await bot.persistence.run_async(bot.persistence.backend.is_empty)
+    else:
+        bot.helper.refresh()
     print('Loading cogs')
     cog_paths = ["Cogs." + os.path.splitext(file)[0] for file in os.listdir("Cogs") if file.endswith(".py")]
     load_extensions(cog_paths)
+    if import_storage:
+        await import_json_storage()
     print('Ready')
     print('------')
     logging.info("Carat online")
 
 
+async def import_json_storage() -> Dict[str, int]:
+    logging.warning("Importing JSON storage into the database")
+    counts = await bot.persistence.import_from(persistence.JsonBackend())
+    logging.warning("Imported storage: " + ", ".join(f"{name}: {count}" for name, count in counts.items()))
+    # the cogs still hold what they loaded before the import, so they are reloaded from the imported data
+    cog_paths = ["Cogs." + os.path.splitext(file)[0] for file in os.listdir("Cogs") if file.endswith(".py")]
+    for cog in cog_paths:
+        if cog[5:] in bot.cogs:
+            bot.unload_extension(cog)
+    load_extensions(cog_paths)
+    return counts
+
+
 def load_extensions(paths: List[str]):
     for extension in paths:
         try:
@@ -132,6 +193,22 @@ async def SendLogs(ctx: commands.Context, limit: int, level: Optional[str] = "ER
         logging.warning(f"{ctx.author.display_name} (id: {ctx.author.id}) attempted to access Carat's logs")
 
 
+@bot.command()
+async def ShowTimers(ctx: commands.Context):
+    """Lists the recurring jobs with their next run and how long their runs took. Restricted to developers."""
+    if ctx.author.id == utility.OwnerID or ctx.author.id in utility.DeveloperIDs:
+        await utility.start_processing(ctx)
+        # jobs of cogs that aren't loaded, or that were retired, are only kept for their state
+        jobs = sorted((job for name, job in bot.timers.jobs.items() if name in bot.timers.callbacks),
+                      key=lambda job: job.next_run)
+        lines = [job.explain() for job in jobs] or ["No recurring jobs are registered"]
+        for message in utility.pack_lines(lines):
+            await utility.dm_user(ctx.author, message)
+        await utility.finish_processing(ctx)
+    else:
+        await utility.deny_command(ctx, "You lack permission for this command")
+
+
 def get_repo_info(sub_path: str) -> Optional[List]:
     try:
         response = requests.get(repository_api_url + "/contents" + sub_path,
@@ -213,27 +290,45 @@ async def ReloadCogs(ctx: commands.Context):
 @bot.command()
 @commands.is_owner()
 async def ReloadMainFiles(ctx: commands.Context):
-    """Loads newest version of main files (Carat.py, utility.py) from GitHub repository. Restricted to bot owner"""
-    logging.warning("Attempting to update Carat.py and utility.py")
+    """Loads newest version of main files (Carat.py and the modules next to it) from GitHub repository.
+    Restricted to bot owner"""
+    logging.warning("Attempting to update " + ", ".join(MainFiles))
     repo_contents = get_repo_info("/")
     if repo_contents is None:
         await utility.deny_command(ctx, "Could not connect to GitHub")
         return
-    carat_file_url = next((file['download_url'] for file in repo_contents if file['name'] == "Carat.py"), None)
-    utility_file_url = next((file['download_url'] for file in repo_contents if file['name'] == "utility.py"), None)
-    if carat_file_url is None or utility_file_url is None:
-        logging.error("Could not find files in repository")
+    file_urls = {file['name']: file['download_url'] for file in repo_contents if file['name'] in MainFiles}
+    if len(file_urls) != len(MainFiles):
+        logging.error("Could not find files in repository: " + ", ".join(set(MainFiles) - set(file_urls)))
         await utility.deny_command(ctx, "Could not find files in repository")
         return
-    if download_file(carat_file_url, ".", "Carat_UPDATE.py"):
-        if download_file(utility_file_url, ".", "utility_UPDATE.py"):
-            logging.warning("New files downloaded.Stopping Carat to restart new version")
-            await bot.close()
-        else:
-            os.remove("Carat_UPDATE.py")  # Clean up
+    downloaded = []
+    # Carat.py comes last - AutoRestart only applies the update once Carat_UPDATE.py exists
+    for file in sorted(MainFiles, key=lambda name: name == "Carat.py"):
+        update_file = os.path.splitext(file)[0] + "_UPDATE.py"
+        if not download_file(file_urls[file], ".", update_file):
+            for update_file in downloaded:
+                os.remove(update_file)  # Clean up
             await utility.deny_command(ctx, "Could not connect to GitHub")
-    else:
-        await utility.deny_command(ctx, "Could not connect to GitHub")
+            return
+        downloaded.append(update_file)
+    logging.warning("New files downloaded.Stopping Carat to restart new version")
+    await bot.close()
+
+
+@bot.command()
+@commands.is_owner()
+async def MigrateStorage(ctx: commands.Context):
+    """Imports the existing JSON storage files into the SQLite database, then reloads all cogs from it.
+    Only available with STORAGE_BACKEND=sqlite. Restricted to bot owner"""
+    if not isinstance(bot.persistence.backend, database.SqliteBackend):
+        await utility.deny_command(ctx, "Storage backend is not set to sqlite")
+        return
+    await utility.start_processing(ctx)
+    counts = await import_json_storage()
+    await utility.dm_user(ctx.author, "Imported into database: " +
+                          ", ".join(f"{name} ({count})" for name, count in counts.items()))
+    await utility.finish_processing(ctx)
 
 
 @bot.command()
@@ -1,56 +1,121 @@
-import json
+from __future__ import annotations
+
+import asyncio
+import logging
 import os.path
+import time
 from dataclasses import dataclass, field
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 import nextcord
-from dataclasses_json import dataclass_json
 from nextcord import InvalidArgument, HTTPException
-from nextcord.ext import tasks, commands
+from nextcord.ext import commands
 from nextcord.utils import get
 
+import scheduling
 import utility
+from Cogs.Townsquare import Townsquare
+from codec import serializable
 
 ivy_id = 183474450237358081
+ExcludedChannels = [1218704547585724537, 1218706422297137272, 777660207424733204, 1173738081036283924]
+CopyWorkers = 8  # messages whose attachments and reactions are fetched at the same time
+CopyPrefetch = 50  # messages read ahead of the one being sent, bounds the attachments held in memory
+KeepAliveMargin = 12 * 3600  # seconds before a game thread would archive that it is kept alive, at most
 
-@dataclass_json
+@serializable
 @dataclass
 class ThreadList:
     private_to_archive: List[int] = field(default_factory=list)
     public_to_not_archive: List[int] = field(default_factory=list)
 
 
-async def copy_history(target: nextcord.abc.Messageable, history) -> int:
-    errors = 0
-    async for message in history:
-        embed = nextcord.Embed(description=message.content)
-        embed.set_author(name=str(message.author) + " at " + str(message.created_at),
-                         icon_url=message.author.display_avatar.url)
-        attachment_list = []
-        for i in message.attachments:
-            attachment_list.append(await i.to_file())
-        for i in message.reactions:
-            user_list = []
-            async for user in i.users():
-                user_list.append(str(user.name))
-            reactors = ", ".join(user_list)
-            if not embed.footer.text or len(embed.footer.text) == 0:
-                embed.set_footer(text=f"{i.emoji} - {reactors}, ")
-            else:
-                embed.set_footer(text=embed.footer.text + f" {i.emoji} - {reactors}, ")
-        try:
-            await target.send(embed=embed, files=attachment_list)
-        except InvalidArgument:
+@dataclass
+class CopyReport:
+    messages: int = 0
+    errors: int = 0
+    seconds: float = 0
+
+    def add(self, other: CopyReport):
+        self.messages += other.messages
+        self.errors += other.errors
+        self.seconds += other.seconds
+
+    def rate(self) -> float:
+        return self.messages / self.seconds if self.seconds > 0 else 0
+
+
+async def reaction_users(reaction: nextcord.Reaction) -> str:
+    return ", ".join([str(user.name) async for user in reaction.users()])
+
+
+async def prepare_copy(message: nextcord.Message) -> Tuple[nextcord.Embed, List[nextcord.File]]:
+    embed = nextcord.Embed(description=message.content)
+    embed.set_author(name=str(message.author) + " at " + str(message.created_at),
+                     icon_url=message.author.display_avatar.url)
+    attachment_list, reactors = await asyncio.gather(
+        asyncio.gather(*[attachment.to_file() for attachment in message.attachments]),
+        asyncio.gather(*[reaction_users(reaction) for reaction in message.reactions]))
+    if message.reactions:
+        embed.set_footer(text=" ".join(f"{reaction.emoji} - {users}, "
+                                       for reaction, users in zip(message.reactions, reactors)))
+    return embed, list(attachment_list)
+
+
+async def send_copy(target: nextcord.abc.Messageable, embed: nextcord.Embed, attachment_list: List[nextcord.File]) \
+        -> int:
+    try:
+        await target.send(embed=embed, files=attachment_list)
+    except InvalidArgument:
+        embed.set_footer(text=f"{embed.footer.text}\nError: Attachment file was too large.")
+        await target.send(embed=embed)
+    except HTTPException as e:
+        if e.status == 413:
             embed.set_footer(text=f"{embed.footer.text}\nError: Attachment file was too large.")
             await target.send(embed=embed)
-        except HTTPException as e:
-            if e.status == 413:
-                embed.set_footer(text=f"{embed.footer.text}\nError: Attachment file was too large.")
-                await target.send(embed=embed)
-            else:
-                await target.send(f"Error: this message caused an unknown issue: {e.status} - {e.text}")
-                errors += 1
-    return errors
+        else:
+            await target.send(f"Error: this message caused an unknown issue: {e.status} - {e.text}")
+            return 1
+    return 0
+
+
+async def copy_history(target: nextcord.abc.Messageable, history) -> CopyReport:
+    # a reader pulls history pages ahead, a bounded pool downloads attachments and reaction users, and the
+    # writer sends the copies one at a time in their original order - nextcord waits out the channel's rate limit
+    start = time.perf_counter()
+    report = CopyReport()
+    workers = asyncio.Semaphore(CopyWorkers)
+    pending: asyncio.Queue = asyncio.Queue(CopyPrefetch)  # preparation tasks in message order, None at the end
+
+    async def prepare(message: nextcord.Message):
+        async with workers:
+            return await prepare_copy(message)
+
+    async def read():
+        try:
+            async for message in history:
+                await pending.put(asyncio.create_task(prepare(message)))
+        except Exception:
+            await pending.put(None)
+            raise
+        await pending.put(None)
+
+    reader = asyncio.create_task(read())
+    try:
+        while (task := await pending.get()) is not None:
+            embed, attachment_list = await task
+            report.errors += await send_copy(target, embed, attachment_list)
+            report.messages += 1
+        await reader  # raises if reading the history failed
+    finally:
+        reader.cancel()
+        while not pending.empty():
+            task = pending.get_nowait()
+            if task is not None:
+                task.cancel()
+    report.seconds = time.perf_counter() - start
+    logging.info(f"Copied {report.messages} messages to {target} at {report.rate():.1f} messages per second")
+    return report
 
 
 class Archive(commands.Cog):
@@ -58,27 +123,37 @@ class Archive(commands.Cog):
     helper: utility.Helper
     ThreadArchivalStorage: str
     threads_by_channel: Dict[int, ThreadList]
+    thread_activity: Dict[int, float]  # last activity seen per tracked thread, as seconds since the epoch
+    keep_alive_timer: scheduling.HeapTimer
 
     def __init__(self, bot: commands.Bot, helper: utility.Helper):
         self.bot = bot
         self.helper = helper
         self.ThreadArchivalStorage = os.path.join(self.helper.StorageLocation, "thread_archival.json")
         self.threads_by_channel = {}
-        if not os.path.exists(self.ThreadArchivalStorage):
-            with open(self.ThreadArchivalStorage, 'w') as f:
-                json.dump(self.threads_by_channel, f, indent=2)
+        self.helper.Persistence.register_document("thread_archival", self.ThreadArchivalStorage, self.serialize)
+        json_data = self.helper.Persistence.load_document("thread_archival")
+        if json_data is None:
+            self.update_storage()
         else:
-            with open(self.ThreadArchivalStorage, 'r') as f:
-                json_data = json.load(f)
             for channel in json_data:
                 self.threads_by_channel[channel] = ThreadList.from_dict(json_data[channel])
+        # game threads are only kept from archiving when they are about to, see keep_thread_alive
+        self.thread_activity = {}
+        self.keep_alive_timer = scheduling.HeapTimer(self.keep_thread_alive)
+        for thread in self.helper.Guild.threads:
+            self.track_thread(thread)
+        self.keep_alive_timer.start()
+
+    def cog_unload(self):
+        self.keep_alive_timer.stop()
+        self.helper.Persistence.unregister("thread_archival")
+
+    def serialize(self) -> dict:
+        return {channel: self.threads_by_channel[channel].to_dict() for channel in self.threads_by_channel}
 
     def update_storage(self):
-        json_data = {}
-        for channel in self.threads_by_channel:
-            json_data[channel] = self.threads_by_channel[channel].to_dict()
-        with open(self.ThreadArchivalStorage, 'w') as f:
-            json.dump(json_data, f, indent=2)
+        self.helper.Persistence.mark_dirty("thread_archival")
 
     @commands.command()
     async def IncludeInArchive(self, ctx: commands.Context):
@@ -186,7 +261,7 @@ class Archive(commands.Cog):
             
             channel_history = channel_to_archive.history(limit=None, oldest_first=True)
 
-            errors = await copy_history(archive_channel, channel_history)
+            report = await copy_history(archive_channel, channel_history)
 
             for thread in channel_to_archive.threads:
                 if thread.is_private() and (thread.parent.id not in self.threads_by_channel or
@@ -201,7 +276,7 @@ class Archive(commands.Cog):
                             reason="Private Thread"
                             )
                         thread_history = thread.history(limit=None, oldest_first=True)
-                        errors += await copy_history(archive_thread, thread_history)
+                        report.add(await copy_history(archive_thread, thread_history))
                         continue
                     except HTTPException:
                         await archive_channel.send(f"Failed to create thread '{thread.name}'")
@@ -215,7 +290,7 @@ class Archive(commands.Cog):
                     archive_thread = await archive_channel.create_thread(name=thread.name,
                                                                          type=nextcord.ChannelType.public_thread)
                     thread_history = thread.history(limit=None, oldest_first=True)
-                    errors += await copy_history(archive_thread, thread_history)
+                    report.add(await copy_history(archive_thread, thread_history))
                 except HTTPException:
                     await archive_channel.send(f"Failed to create thread '{thread.name}'")
                     continue
@@ -229,35 +304,96 @@ class Archive(commands.Cog):
             self.update_storage()
 
             await self.helper.log(f"{ctx.author.display_name} has run the OffServerArchive Command")
-            message = f"Your Archive for {ctx.message.channel.name} is done."
-            if errors > 0:
-                message += f" {errors} messages caused unknown errors and were not archived."
+            message = f"Your Archive for {ctx.message.channel.name} is done. {report.messages} messages were copied " \
+                      f"at {report.rate():.1f} messages per second."
+            if report.errors > 0:
+                message += f" {report.errors} messages caused unknown errors and were not archived."
             await utility.dm_user(ctx.author, message)
         else:
             await utility.deny_command(ctx, "You do not have permission to use this command")
 
-    @tasks.loop(hours=24)
-    async def adjust_thread_archive_time():
+    def archive_deadline(self, thread: nextcord.Thread) -> float:
+        # Discord archives a thread once it has been inactive for its auto archive duration
+        activity = max(self.thread_activity.get(thread.id, 0), thread.archive_timestamp.timestamp())
+        if thread.last_message_id is not None:
+            activity = max(activity, nextcord.utils.snowflake_time(thread.last_message_id).timestamp())
+        return activity + thread.auto_archive_duration * 60
 
-        guild = bot.get_guild(569683781800296501)
-        EXCLUDED_CHANNELS = [1218704547585724537, 1218706422297137272, 777660207424733204, 1173738081036283924]
-        ACTIVE_THREAD_CATEGORIES = [569683781846433930]
+    def keep_alive_time(self, thread: nextcord.Thread) -> float:
+        margin = min(KeepAliveMargin, thread.auto_archive_duration * 30)
+        return self.archive_deadline(thread) - margin
 
-        for current_thread_ID in ACTIVE_THREAD_CATEGORIES:
-            category = nextcord.utils.get(guild.categories, id=current_thread_ID)
+    def track_thread(self, thread: nextcord.Thread):
+        if thread.guild.id == self.helper.Guild.id and not thread.archived:
+            self.thread_activity.setdefault(thread.id, 0)
+            self.keep_alive_timer.schedule(thread.id, self.keep_alive_time(thread))
+
+    def untrack_thread(self, thread_id: int):
+        self.thread_activity.pop(thread_id, None)
+        self.keep_alive_timer.cancel(thread_id)
+
+    def belongs_to_live_game(self, thread: nextcord.Thread) -> bool:
+        if thread.parent_id in ExcludedChannels:
+            return False
+        if thread.parent is not None and thread.parent.category_id == self.helper.TextGamesCategory.id:
+            # ST threads and nomination threads, until the game channel is archived
+            return True
+        townsquare_cog: Optional[Townsquare] = self.bot.get_cog("Townsquare")
+        # log threads live in the kibitz channel
+        return townsquare_cog is not None and thread.id in townsquare_cog.log_thread_ids
+
+    async def keep_thread_alive(self, thread_id: int):
+        thread = self.helper.Guild.get_thread(thread_id)
+        if thread is None or thread.archived or not self.belongs_to_live_game(thread):
+            # a thread that comes back to life is tracked again by its update or join event
+            self.thread_activity.pop(thread_id, None)
+            return
+        if self.keep_alive_time(thread) > time.time():
+            # there was activity since this was scheduled
+            self.keep_alive_timer.schedule(thread_id, self.keep_alive_time(thread))
+            return
+        duration = thread.auto_archive_duration
+        try:
+            # changing the duration resets the thread's inactivity timer
+            await thread.edit(auto_archive_duration=4320 if duration == 10080 else 10080)
+            await thread.edit(auto_archive_duration=duration)
+            self.thread_activity[thread_id] = time.time()
+            logging.debug(f"Kept thread {thread.name} in channel {thread.parent} from archiving")
+        except HTTPException as e:
+            logging.warning(f"Failed to update thread: {thread.name} in channel: {thread.parent}. Error: {e}")
+            return
+        self.keep_alive_timer.schedule(thread_id, self.keep_alive_time(thread))
+
+    @commands.Cog.listener()
+    async def on_message(self, message: nextcord.Message):
+        # only a timestamp per message - the timer catches up with it when it next comes up
+        if message.channel.id in self.thread_activity:
+            self.thread_activity[message.channel.id] = time.time()
+
+    @commands.Cog.listener()
+    async def on_thread_create(self, thread: nextcord.Thread):
+        self.track_thread(thread)
+
+    @commands.Cog.listener()
+    async def on_thread_join(self, thread: nextcord.Thread):
+        self.track_thread(thread)
+
+    @commands.Cog.listener()
+    async def on_thread_update(self, before: nextcord.Thread, after: nextcord.Thread):
+        if after.archived:
+            self.untrack_thread(after.id)
+        else:
+            self.track_thread(after)
+
+    @commands.Cog.listener()
+    async def on_thread_delete(self, thread: nextcord.Thread):
+        self.untrack_thread(thread.id)
+
+    @commands.Cog.listener()
+    async def on_thread_remove(self, thread: nextcord.Thread):
+        self.untrack_thread(thread.id)
 
-            for channel in category.channels:
-                if channel.id in EXCLUDED_CHANNELS:
-                    continue
-            
-                threads = await channel.threads()
-                for thread in threads:
-                    try:
-                        await thread.edit(auto_archive_duration=10080)  # 10080 minutes = 7 days
-                        await thread.edit(auto_archive_duration=4320)  # 4,320 minutes = 3 days
-                    except Exception as e:
-                        print(f"Failed to update thread: {thread.name} in channel: {channel.name}. Error: {e}")
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Archive(bot, utility.Helper(bot)))
+    bot.add_cog(Archive(bot, utility.get_helper(bot)))
 
@@ -91,8 +91,9 @@ class Game(commands.Cog):
 
             townsquare: Optional[Townsquare] = self.bot.get_cog("Townsquare")
             if townsquare and game_number in townsquare.town_squares:
-                townsquare.town_squares.pop(game_number)
-                townsquare.update_storage()
+                async with townsquare.game_lock(game_number):
+                    townsquare.town_squares.discard(game_number)
+                    townsquare.journal_delete(game_number)
 
             # Change permission of Kibitz to allow Townsfolk to view
             townsfolk_role = self.helper.Guild.default_role
@@ -162,4 +163,4 @@ class Game(commands.Cog):
 
 
 def setup(bot):
-    bot.add_cog(Game(bot, utility.Helper(bot)))
+    bot.add_cog(Game(bot, utility.get_helper(bot)))
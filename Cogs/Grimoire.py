@@ -114,7 +114,10 @@ class Grimoire(commands.Cog):
             await member.add_roles(self.helper.get_st_role(game_number))
             townsquare: Optional[Townsquare] = self.bot.get_cog('Townsquare')
             if townsquare and game_number in townsquare.town_squares:
-                townsquare.town_squares[game_number].sts.append(Player(member.id, member.display_name))
+                async with townsquare.game_lock(game_number):
+                    town_square = await townsquare.town_squares.load(game_number)
+                    town_square.sts.append(Player(member.id, member.display_name))
+                    townsquare.journal_town_square(game_number)
             dm_content = f"You have assigned the ST role for game {game_number} to {member.display_name}"
             dm_success = await utility.dm_user(ctx.author, dm_content)
             if not dm_success:
@@ -152,4 +155,4 @@ class Grimoire(commands.Cog):
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Grimoire(bot, utility.Helper(bot)))
+    bot.add_cog(Grimoire(bot, utility.get_helper(bot)))
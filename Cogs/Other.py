@@ -49,7 +49,7 @@ class Other(commands.Cog):
             await utility.start_processing(ctx)
             townsquare_cog: typing.Optional[Townsquare] = self.bot.get_cog("Townsquare")
             if townsquare_cog is not None and game_number in townsquare_cog.town_squares:
-                townsquare = townsquare_cog.town_squares[game_number]
+                townsquare = await townsquare_cog.town_squares.load(game_number)
             else:
                 townsquare = None
             for player in self.helper.get_game_role(game_number).members:
@@ -486,4 +486,4 @@ class Other(commands.Cog):
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Other(bot, utility.Helper(bot)))
+    bot.add_cog(Other(bot, utility.get_helper(bot)))
@@ -1,20 +1,23 @@
 from __future__ import annotations
 
+import asyncio
 import datetime
-import json
+import heapq
 import logging
 import os
 import re
 from dataclasses import dataclass
-from typing import Optional
+from typing import Dict, List, Optional
 
-from dataclasses_json import dataclass_json
-from nextcord.ext import commands, tasks
+import nextcord
+from nextcord.ext import commands
 from nextcord.utils import utcnow, format_dt
 
 import utility
+from codec import serializable
 
 hours_pattern = re.compile(r"^(\d+):([0-5]\d)$")
+ReminderMergeWindow = 60  # seconds - reminders for one channel due this close together are sent as one message
 
 
 def parse_hours(inp: str) -> float:
@@ -25,18 +28,23 @@ def parse_hours(inp: str) -> float:
         return float(inp)
 
 
-@dataclass_json
+@serializable
 @dataclass(order=True)
 class Reminder:
-    time: str
+    time: int  # seconds since the epoch
     channel: int
     text: str
 
+    def __post_init__(self):
+        if isinstance(self.time, str):
+            # stored as an ISO timestamp by older versions
+            self.time = int(datetime.datetime.fromisoformat(self.time).timestamp())
+
     def explain(self) -> str:
         text_elements = self.text.split(" ")
         # remove role pings
         text_elements = [el for el in text_elements[:2] if not el.startswith("<@&")] + text_elements[2:]
-        time = datetime.datetime.fromisoformat(self.time)
+        time = datetime.datetime.fromtimestamp(self.time, datetime.timezone.utc)
         if self.text[-4:] == ":t>)":
             event = " ".join(text_elements[:-2])
             explanation = f"{format_dt(time, 'R')} ({format_dt(time, 'f')}): Reminder that `{event}` at " \
@@ -51,37 +59,60 @@ class Reminder:
                end_of_countdown: datetime.datetime) -> Reminder:
         text = event if mention is None else f"{mention} {event}"
         if time == end_of_countdown:
-            return Reminder(time.isoformat(), channel, text)
+            return Reminder(int(time.timestamp()), channel, text)
         text += f" {format_dt(end_of_countdown, 'R')} ({format_dt(end_of_countdown, 't')})"
-        return Reminder(time.isoformat(), channel, text)
+        return Reminder(int(time.timestamp()), channel, text)
 
 
 class Reminders(commands.Cog):
     bot: commands.Bot
     helper: utility.Helper
-    reminder_list: list[Reminder]
+    reminder_list: list[Reminder]  # a heap, earliest reminder first - may still hold reminders that were deleted
+    reminders_by_channel: Dict[int, List[Reminder]]  # the reminders that are actually scheduled
     ReminderStorage: str
+    wakeup: asyncio.Event
+    reminder_task: asyncio.Task
 
     def __init__(self, bot: commands.Bot, helper: utility.Helper):
         self.bot = bot
         self.helper = helper
         self.ReminderStorage = os.path.join(self.helper.StorageLocation, "reminders.json")
         self.reminder_list = []
-        if not os.path.exists(self.ReminderStorage):
-            with open(self.ReminderStorage, 'w') as f:
-                json.dump(self.reminder_list, f, indent=2)
+        self.reminders_by_channel = {}
+        self.wakeup = asyncio.Event()
+        self.helper.Persistence.register_document("reminders", self.ReminderStorage, self.serialize)
+        json_data = self.helper.Persistence.load_document("reminders")
+        if json_data is None:
+            self.update_storage()
         else:
-            with open(self.ReminderStorage, 'r') as f:
-                self.reminder_list = [Reminder.from_dict(item) for item in json.load(f)]
-            self.reminder_list.sort()
-        self.check_reminders.start()
+            for item in json_data:
+                reminder = Reminder.from_dict(item)
+                self.reminders_by_channel.setdefault(reminder.channel, []).append(reminder)
+                self.reminder_list.append(reminder)
+            heapq.heapify(self.reminder_list)
+        self.reminder_task = asyncio.create_task(self.run_reminders())
 
     def cog_unload(self):
-        self.check_reminders.cancel()
+        self.reminder_task.cancel()
+        self.helper.Persistence.unregister("reminders")
+
+    def serialize(self) -> list:
+        return [item.to_dict() for reminders in self.reminders_by_channel.values() for item in reminders]
+
+    def add_reminders(self, reminders: List[Reminder]):
+        # O(log n) per reminder, and a single wakeup and storage write for all of them
+        for reminder in reminders:
+            heapq.heappush(self.reminder_list, reminder)
+            self.reminders_by_channel.setdefault(reminder.channel, []).append(reminder)
+        self.wakeup.set()
+        self.update_storage()
+
+    def is_scheduled(self, reminder: Reminder) -> bool:
+        # compares identity, two reminders with the same time and text are still different reminders
+        return any(r is reminder for r in self.reminders_by_channel.get(reminder.channel, []))
 
     def update_storage(self):
-        with open(self.ReminderStorage, 'w') as f:
-            json.dump([item.to_dict() for item in self.reminder_list], f, indent=2)
+        self.helper.Persistence.mark_dirty("reminders")
 
     @commands.command(usage="<game_number> [event] [times]... <'ping-st'> <'no-player-ping'>")
     async def SetReminders(self, ctx, *args):
@@ -127,13 +158,10 @@ class Reminders(commands.Cog):
                 mention = st_role.mention if mention is None else f"{st_role.mention} {mention}"
             times.sort()
             end_of_countdown = utcnow() + datetime.timedelta(hours=times[-1])
-            for time in times:
-                reminder = Reminder.create(utcnow() + datetime.timedelta(hours=time), game_channel.id, mention, event,
-                                           end_of_countdown)
-                self.reminder_list.append(reminder)
-                logging.debug(f"Added reminder in game {game_number}: {reminder}")
-            self.reminder_list.sort()
-            self.update_storage()
+            reminders = [Reminder.create(utcnow() + datetime.timedelta(hours=time), game_channel.id, mention, event,
+                                         end_of_countdown) for time in times]
+            self.add_reminders(reminders)
+            logging.debug(f"Added reminders in game {game_number}: {reminders}")
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You must be an ST to use this command")
@@ -144,7 +172,8 @@ class Reminders(commands.Cog):
         game_channel_id = self.helper.get_game_channel(game_number).id
         if self.helper.authorize_st_command(ctx.author, game_number):
             await utility.start_processing(ctx)
-            self.reminder_list = [reminder for reminder in self.reminder_list if reminder.channel != game_channel_id]
+            # their heap entries are skipped once they come up
+            self.reminders_by_channel.pop(game_channel_id, None)
             self.update_storage()
             await utility.finish_processing(ctx)
         else:
@@ -155,24 +184,74 @@ class Reminders(commands.Cog):
         """Shows all reminders for the given game number."""
         game_channel_id = self.helper.get_game_channel(game_number).id
         await utility.start_processing(ctx)
-        reminders = [reminder for reminder in self.reminder_list if reminder.channel == game_channel_id]
+        stored = await self.helper.Persistence.lookup("reminders", "by_channel", game_channel_id)
+        if stored is None:
+            reminders = sorted(self.reminders_by_channel.get(game_channel_id, []))
+        else:
+            reminders = [Reminder.from_dict(reminder) for reminder in stored]
         if len(reminders) == 0:
             await utility.dm_user(ctx.author, "There are no reminders for this game")
         else:
             await utility.dm_user(ctx.author, "\n".join([reminder.explain() for reminder in reminders]))
         await utility.finish_processing(ctx)
 
-    @tasks.loop(seconds=15)
-    async def check_reminders(self):
-        if len(self.reminder_list) == 0:
-            return
-        earliest_reminder = self.reminder_list[0]
-        if datetime.datetime.fromisoformat(earliest_reminder.time) <= utcnow():
-            channel = self.bot.get_channel(earliest_reminder.channel)
-            await channel.send(earliest_reminder.text)
-            self.reminder_list.pop(0)
+    async def run_reminders(self):
+        # sleeps until the earliest reminder is due, or until SetReminders adds an earlier one, then sends every
+        # reminder that is due by then at once - after downtime, that is everything that was missed
+        await self.bot.wait_until_ready()
+        while True:
+            self.wakeup.clear()
+            while self.reminder_list and not self.is_scheduled(self.reminder_list[0]):
+                heapq.heappop(self.reminder_list)
+            delay = self.reminder_list[0].time - utcnow().timestamp() if self.reminder_list else None
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.send_due_reminders()
+            except Exception as e:
+                # the reminders that were due are dropped rather than stopping every later one
+                logging.exception(f"Failed to send due reminders: {e}")
             self.update_storage()
 
+    async def send_due_reminders(self):
+        now = utcnow().timestamp()
+        channels = set()
+        while self.reminder_list and self.reminder_list[0].time <= now:
+            reminder = heapq.heappop(self.reminder_list)
+            if self.is_scheduled(reminder):
+                channels.add(reminder.channel)
+        batches = []
+        for channel_id in channels:
+            # whatever else is due for the channel within the merge window goes along, e.g. the ping-st reminders
+            # set right after the player ones
+            reminders = self.reminders_by_channel.pop(channel_id)
+            batch = sorted(r for r in reminders if r.time <= now + ReminderMergeWindow)
+            remaining = [r for r in reminders if r.time > now + ReminderMergeWindow]
+            if remaining:
+                self.reminders_by_channel[channel_id] = remaining
+            batches.append((channel_id, batch))
+        results = await asyncio.gather(*[self.send_reminders(channel_id, batch) for channel_id, batch in batches],
+                                       return_exceptions=True)
+        for (channel_id, batch), result in zip(batches, results):
+            if isinstance(result, Exception):
+                logging.error(f"Dropping {len(batch)} reminders for channel {channel_id} that failed to send: {result}")
+
+    async def send_reminders(self, channel_id: int, reminders: List[Reminder]):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            logging.warning(f"Dropping {len(reminders)} reminders for missing channel {channel_id}")
+            return
+        texts = list(dict.fromkeys(reminder.text for reminder in reminders))
+        try:
+            for message in utility.pack_lines(texts):
+                await channel.send(message)
+        except nextcord.HTTPException as e:
+            logging.error(f"Failed to send reminders in channel {channel_id}: {e}")
+
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Reminders(bot, utility.Helper(bot)))
+    bot.add_cog(Reminders(bot, utility.get_helper(bot)))
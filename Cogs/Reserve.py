@@ -1,19 +1,18 @@
 import datetime
 import io
-import json
 import logging
 import os
 import traceback
 from dataclasses import dataclass, field
-from datetime import date, timedelta, time
+from datetime import date, timedelta
 from typing import Optional, Dict, List
 
 import nextcord
-from dataclasses_json import dataclass_json
-from nextcord.ext import commands, tasks
+from nextcord.ext import commands
 from nextcord.utils import get, utcnow, format_dt
 
 import utility
+from codec import serializable
 from Cogs.TextQueue import TextQueue, Entry, ExplainInvalidChannelType
 
 green_square_emoji = '\U0001F7E9'
@@ -22,7 +21,7 @@ refresh_emoji = '\U0001F504'
 min_advance_days = 14
 
 
-@dataclass_json
+@serializable
 @dataclass
 class RSVPEntry:
     thread: int
@@ -38,15 +37,15 @@ class RSVPEntry:
 def default_game_channel_overwrites(game_role: nextcord.Role, st_role: nextcord.Role, helper: utility.Helper) \
         -> Dict[nextcord.Role, nextcord.PermissionOverwrite]:
     permissions = {}
-    total_ban_role = get(helper.Guild.roles, name="tb")
+    total_ban_role = helper.Index.roles.get("tb")
     if total_ban_role is not None:
         permissions[total_ban_role] = nextcord.PermissionOverwrite(send_messages=False, send_messages_in_threads=False,
                                                                    create_public_threads=False,
                                                                    create_private_threads=False, add_reactions=False)
-    game_ban_role = get(helper.Guild.roles, name="gb")
+    game_ban_role = helper.Index.roles.get("gb")
     if game_ban_role is not None:
         permissions[game_ban_role] = nextcord.PermissionOverwrite(send_messages=False, view_channel=False)
-    ni_text_role = get(helper.Guild.roles, name="NIText")
+    ni_text_role = helper.Index.roles.get("NIText")
     if ni_text_role is not None:
         permissions[ni_text_role] = nextcord.PermissionOverwrite(view_channel=False)
     permissions[game_role] = nextcord.PermissionOverwrite(send_messages_in_threads=True, create_public_threads=False,
@@ -64,9 +63,9 @@ async def default_kibitz_channel_overwrites(game_role: nextcord.Role,
                                             helper: utility.Helper
                                             ) -> Dict[nextcord.Role, nextcord.PermissionOverwrite]:
     permissions = {}
-    bot_role = get(helper.Guild.roles, name=(await helper.bot.application_info()).name)
+    bot_role = helper.Index.roles.get((await helper.bot.application_info()).name)
     permissions[bot_role] = nextcord.PermissionOverwrite(view_channel=True)
-    total_ban_role = get(helper.Guild.roles, name="tb")
+    total_ban_role = helper.Index.roles.get("tb")
     if total_ban_role is not None:
         permissions[total_ban_role] = nextcord.PermissionOverwrite(send_messages=False, send_messages_in_threads=False,
                                                                    create_public_threads=False,
@@ -74,7 +73,7 @@ async def default_kibitz_channel_overwrites(game_role: nextcord.Role,
     permissions[st_role] = nextcord.PermissionOverwrite(view_channel=True, send_messages=True, manage_messages=True)
     permissions[game_role] = nextcord.PermissionOverwrite(view_channel=False, send_messages=False)
     permissions[kibitz_role] = nextcord.PermissionOverwrite(view_channel=True, send_messages=True)
-    blind_role = get(helper.Guild.roles, name="blind")
+    blind_role = helper.Index.roles.get("blind")
     if blind_role is not None:
         permissions[blind_role] = nextcord.PermissionOverwrite(view_channel=False)
     permissions[helper.Guild.default_role] = nextcord.PermissionOverwrite(view_channel=False)
@@ -178,18 +177,19 @@ async def create_channel(owner: int, helper: utility.Helper,
     else:
         await kibitz_channel.edit(reason=reason, overwrites=kibitz_overwrites)
     # assign roles
-    st = get(helper.Guild.members, id=owner)
-    await st.add_roles(st_role)
     co_sts = [] if co_sts is None else co_sts
-    co_sts = [get(helper.Guild.members, id=st_id) for st_id in co_sts]
+    players = [] if players is None else players
+    members = await helper.Members.fetch_many([owner] + co_sts + players)
+    st = members[owner]
+    await st.add_roles(st_role)
+    co_sts = [members[st_id] for st_id in co_sts]
     for co_st in co_sts:
         if co_st is not None:
             await co_st.add_roles(st_role)
-    players = [] if players is None else players
-    players = [(p_id, get(helper.Guild.members, id=p_id)) for p_id in players]
+    players = [(p_id, members[p_id]) for p_id in players]
     for p_id, player in players:
         if player is None:
-            game_channel.send(f"Warning: Player with ID {p_id} could not be found")
+            await game_channel.send(f"Warning: Player with ID {p_id} could not be found")
         else:
             await player.add_roles(game_role)
     await game_channel.send(f"{st_role.mention} Channel is ready. Have fun!")
@@ -209,10 +209,10 @@ async def switch_to_queue(queue_cog: TextQueue, helper: utility.Helper, entry: R
     pass
 
 
-def signup_embed(entry: RSVPEntry, helper: utility.Helper) -> nextcord.Embed:
-    owner = get(helper.Guild.members, id=entry.owner)
-    co_sts = [get(helper.Guild.members, id=st_id).mention for st_id in entry.co_sts]
-    info = f"Ran by {owner.mention}"
+async def signup_embed(entry: RSVPEntry, helper: utility.Helper) -> nextcord.Embed:
+    members = await helper.Members.fetch_many([entry.owner] + entry.co_sts + entry.players)
+    co_sts = [f"<@{st_id}>" if members[st_id] is None else members[st_id].mention for st_id in entry.co_sts]
+    info = f"Ran by <@{entry.owner}>"
     if len(co_sts) > 0:
         info += "with " + ", ".join(co_sts)
     info += ", starting " + entry.date
@@ -223,10 +223,10 @@ def signup_embed(entry: RSVPEntry, helper: utility.Helper) -> nextcord.Embed:
                            color=0xff0000)
     for i in range(entry.max_players):
         if i < len(entry.players):
-            player = get(helper.Guild.members, id=entry.players[i])
-            name = player.display_name
+            player = members[entry.players[i]]
+            name = player.display_name if player is not None else "Unknown user"
             embed.add_field(name=str(i + 1) + ". " + str(name),
-                            value=f"{player.mention} has signed up",
+                            value=f"<@{entry.players[i]}> has signed up",
                             inline=False)
         else:
             embed.add_field(name=str(i + 1) + ". ", value=" Awaiting Player", inline=False)
@@ -247,29 +247,29 @@ class Reserve(commands.Cog):
         self.ReservedStorage = os.path.join(self.helper.StorageLocation, "reserved.json")
         self.entries = {}
         self.announced = {}
-        if not os.path.exists(self.ReservedStorage):
-            with open(self.ReservedStorage, 'w') as f:
-                json.dump({"entries": self.entries, "announced": self.announced}, f, indent=2)
+        self.helper.Persistence.register_document("reserved", self.ReservedStorage, self.serialize)
+        json_data = self.helper.Persistence.load_document("reserved")
+        if json_data is None:
+            self.update_storage()
         else:
-            with open(self.ReservedStorage, 'r') as f:
-                json_data = json.load(f)
-                for owner in json_data["entries"]:
-                    self.entries[int(owner)] = RSVPEntry.from_dict(json_data["entries"][owner])
-                for owner in json_data["announced"]:
-                    self.announced[int(owner)] = RSVPEntry.from_dict(json_data["announced"][owner])
-        self.check_entries.start()
+            for owner in json_data["entries"]:
+                self.entries[int(owner)] = RSVPEntry.from_dict(json_data["entries"][owner])
+            for owner in json_data["announced"]:
+                self.announced[int(owner)] = RSVPEntry.from_dict(json_data["announced"][owner])
+        # 5 pm UTC, figure that's a good choice to maximize chances of the ST seeing it not much later.
+        # If the bot was down then, the check runs as soon as it is back
+        self.helper.Timers.add_job("reserve_check_entries", self.check_entries, daily_at="17:00")
 
     def cog_unload(self) -> None:
-        self.check_entries.cancel()
+        self.helper.Timers.remove_job("reserve_check_entries")
+        self.helper.Persistence.unregister("reserved")
+
+    def serialize(self) -> dict:
+        return {"entries": {owner: entry.to_dict() for owner, entry in self.entries.items()},
+                "announced": {owner: entry.to_dict() for owner, entry in self.announced.items()}}
 
     def update_storage(self):
-        json_data = {"entries": {}, "announced": {}}
-        for owner in self.entries:
-            json_data["entries"][owner] = self.entries[owner].to_dict()
-        for owner in self.announced:
-            json_data["announced"][owner] = self.announced[owner].to_dict()
-        with open(self.ReservedStorage, "w") as f:
-            json.dump(json_data, f, indent=2)
+        self.helper.Persistence.mark_dirty("reserved")
 
     def remove_entry(self, owner: int):
         self.entries.pop(owner)
@@ -327,7 +327,7 @@ class Reserve(commands.Cog):
             entry.max_players = max_players
             entry.script = script
             self.update_storage()
-            embed = signup_embed(entry, self.helper)
+            embed = await signup_embed(entry, self.helper)
             thread = get(self.helper.ReservingForum.threads, id=entry.thread)
             await thread.send(embed=embed, view=PreSignupView(self, self.helper, entry))
             await utility.finish_processing(ctx)
@@ -387,16 +387,22 @@ class Reserve(commands.Cog):
         """Lists the reserved games starting in the next week, or in the next specified number of days"""
         await utility.start_processing(ctx)
         cutoff = date.today() + datetime.timedelta(days=days)
-        upcoming = sorted([entry for entry in self.entries.values() if date.fromisoformat(entry.date) <= cutoff],
-                          key=lambda e: e.date)
+        stored = await self.helper.Persistence.lookup("reserved", "until", cutoff.isoformat())
+        if stored is None:
+            upcoming = sorted([entry for entry in self.entries.values() if date.fromisoformat(entry.date) <= cutoff],
+                              key=lambda e: e.date)
+        else:
+            upcoming = [RSVPEntry.from_dict(entry) for entry in stored]
         embed = nextcord.Embed(title="Upcoming games",
                                description=f"All reserved games starting in the next {days} days")
         embed.set_thumbnail(self.helper.Guild.icon.url)
+        members = await self.helper.Members.fetch_many(
+            user_id for entry in upcoming for user_id in [entry.owner] + entry.co_sts)
         for entry in upcoming:
-            owner = get(self.helper.Guild.members, id=entry.owner)
+            owner = members[entry.owner]
             if owner is None:
                 continue
-            co_sts = [get(self.helper.Guild.members, id=co_st) for co_st in entry.co_sts]
+            co_sts = [members[co_st] for co_st in entry.co_sts]
             co_st_names = [co_st.display_name for co_st in co_sts if co_st is not None]
             name = f"{owner.display_name} running {entry.script}" if entry.script != "TBA" else f"{owner.display_name}"
             description = f"Starting {entry.date}\n{len(entry.players)}/{entry.min_players} players signed up"
@@ -506,16 +512,13 @@ class Reserve(commands.Cog):
         else:
             await utility.deny_command(ctx, "You do not have permission to use this command")
 
-    # will run every day at 5 pm UTC
-    # (figure that's a good choice to maximize chances of the ST seeing it not much later)
-    @tasks.loop(time=time(hour=17, minute=0))
     async def check_entries(self):
         to_announce = [entry for entry in self.entries.values() if date.fromisoformat(entry.date) <= date.today()]
         if len(to_announce) > 0:
             queue_cog: Optional[TextQueue] = self.bot.get_cog("TextQueue")
         for entry in to_announce:
             thread = get(self.helper.ReservingForum.threads, id=entry.thread)
-            owner = get(self.helper.Guild.members, id=entry.owner)
+            owner = await self.helper.Members.fetch(entry.owner)
             if owner is None:
                 await thread.send("Reserved date has arrived, but owner could not be found")
                 logging.warning(f"r-game thread owner {entry.owner} for thread {entry.thread} could not be found")
@@ -560,8 +563,8 @@ class PreSignupView(nextcord.ui.View):
         else:
             self.entry.players.append(interaction.user.id)
             self.cog.update_storage()
-            await interaction.message.edit(embed=signup_embed(self.entry, self.helper), view=self)
-            owner = get(self.helper.Guild.members, id=self.entry.owner)
+            await interaction.message.edit(embed=await signup_embed(self.entry, self.helper), view=self)
+            owner = await self.helper.Members.fetch(self.entry.owner)
             await utility.dm_user(owner, f"{interaction.user.display_name} ({interaction.user.name}) has signed up for "
                                          f"your reserved {self.entry.script} game")
             await self.helper.log(f"{interaction.user.display_name} ({interaction.user.name}) has signed up for "
@@ -575,8 +578,8 @@ class PreSignupView(nextcord.ui.View):
         else:
             self.entry.players.remove(interaction.user.id)
             self.cog.update_storage()
-            await interaction.message.edit(embed=signup_embed(self.entry, self.helper), view=self)
-            owner = get(self.helper.Guild.members, id=self.entry.owner)
+            await interaction.message.edit(embed=await signup_embed(self.entry, self.helper), view=self)
+            owner = await self.helper.Members.fetch(self.entry.owner)
             await utility.dm_user(owner, f"{interaction.user.display_name} ({interaction.user.name}) has left your "
                                          f"reserved {self.entry.script} game")
             await self.helper.log(f"{interaction.user.display_name} ({interaction.user.name}) has left"
@@ -756,4 +759,4 @@ class NotEnoughPlayersView(nextcord.ui.View):
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Reserve(bot, utility.Helper(bot)))
+    bot.add_cog(Reserve(bot, utility.get_helper(bot)))
@@ -185,4 +185,4 @@ class SignupView(nextcord.ui.View):
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Signup(bot, utility.Helper(bot)))
+    bot.add_cog(Signup(bot, utility.get_helper(bot)))
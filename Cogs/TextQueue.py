@@ -1,5 +1,4 @@
 import io
-import json
 import logging
 import os
 import traceback
@@ -7,18 +6,18 @@ from dataclasses import dataclass, field
 from typing import Literal, Optional, List, Dict
 
 import nextcord
-from dataclasses_json import dataclass_json
 from nextcord import HTTPException
 from nextcord.ext import commands
 from nextcord.utils import get
 
 import utility
+from codec import serializable
 ExplainInvalidChannelType = "Not a valid channel type - accepted forms are `base, b3, b` for base, " \
                             "`regular, standard, normal, reg, r, s, n` for regular, " \
                             "`experimental, exp, x` for experimental - capitalization doesn't matter."
 
 
-@dataclass_json
+@serializable
 @dataclass
 class Entry:
     st: int
@@ -27,7 +26,7 @@ class Entry:
     notes: Optional[str] = None
 
 
-@dataclass_json
+@serializable
 @dataclass
 class StQueue:
     channel_id: int
@@ -47,14 +46,16 @@ class TextQueue(commands.Cog):
         self.helper = helper
         self.QueueStorage = os.path.join(self.helper.StorageLocation, "queue.json")
         self.queues = {}
-        if not os.path.exists(self.QueueStorage):
-            with open(self.QueueStorage, 'w') as f:
-                json.dump(self.queues, f, indent=2)
+        self.helper.Persistence.register_document("queue", self.QueueStorage, self.serialize)
+        json_data = self.helper.Persistence.load_document("queue")
+        if json_data is None:
+            self.update_storage()
         else:
-            with open(self.QueueStorage, 'r') as f:
-                json_data = json.load(f)
-                for queue in json_data:
-                    self.queues[queue] = StQueue.from_dict(json_data[queue])
+            for queue in json_data:
+                self.queues[queue] = StQueue.from_dict(json_data[queue])
+
+    def cog_unload(self):
+        self.helper.Persistence.unregister("queue")
 
     async def update_queue_message(self, queue: StQueue) -> bool:
         channel = get(self.helper.Guild.channels, id=queue.channel_id)
@@ -66,13 +67,14 @@ class TextQueue(commands.Cog):
         embed = message.embeds[0]
         embed.clear_fields()
         spot = 1
-        for entry in queue.entries:
-            user = get(self.helper.Guild.members, id=entry.st)
+        members = await self.helper.Members.fetch_many(entry.st for entry in queue.entries)
+        for entry in list(queue.entries):
+            user = members[entry.st]
             if user is None:
                 queue.entries.remove(entry)
                 message = f"Removed user with ID {entry.st} from queue due to having left the guild"
                 logging.warning(message)
-                await self.helper.log(message)
+                await self.helper.log(message, logging.WARNING)
                 continue
             entry_string = f"Script: {entry.script}\nAvailability: {entry.availability}\n"
             if entry.notes is not None:
@@ -83,7 +85,7 @@ class TextQueue(commands.Cog):
             spot = spot + 1
         await self.helper.log(
             f"Queue updated - current entries: "
-            f"{str([get(self.helper.Guild.members, id=qe.st).display_name for qe in queue.entries])}"[:1950])
+            f"{str([members[qe.st].display_name for qe in queue.entries])}"[:1950])
         queue_posted_completely = True
         success = False
         while not success:
@@ -109,7 +111,7 @@ class TextQueue(commands.Cog):
             await channel.send("There are no further entries in the queue.")
             return
         next_entry = self.queues[channel_type].entries[queue_position]
-        user = get(self.helper.Guild.members, id=next_entry.st)
+        user = await self.helper.Members.fetch(next_entry.st)
         if user is not None:
             content = f"{user.mention} This game channel has become free! You are next in the queue.\n" \
                       f"You may claim the grimoire with >ClaimGrimoire {game_number} or the button below.\n" \
@@ -130,12 +132,11 @@ class TextQueue(commands.Cog):
                 await self.update_queue_message(self.queues[channel_type])
         self.update_storage()
 
+    def serialize(self) -> dict:
+        return {queue: self.queues[queue].to_dict() for queue in self.queues}
+
     def update_storage(self):
-        json_data = {}
-        for queue in self.queues:
-            json_data[queue] = self.queues[queue].to_dict()
-        with open(self.QueueStorage, "w") as f:
-            json.dump(json_data, f, indent=2)
+        self.helper.Persistence.mark_dirty("queue")
 
     def get_queue(self, user_id: int) -> Optional[StQueue]:
         for channel_type in self.queues:
@@ -429,4 +430,4 @@ class FreeChannelNotificationView(nextcord.ui.View):
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(TextQueue(bot, utility.Helper(bot)))
+    bot.add_cog(TextQueue(bot, utility.get_helper(bot)))
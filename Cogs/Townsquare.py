@@ -1,20 +1,26 @@
 from __future__ import annotations
+import asyncio
 import datetime
 import io
-import json
 import logging
 import os
+import re
+import time
 import traceback
+from collections import OrderedDict
 from dataclasses import dataclass, field
 from math import ceil
-from typing import List, Optional, Dict, Union, Callable, Literal
+from typing import List, Optional, Dict, Union, Literal, MutableMapping, Iterator, Tuple, Set
 
 import nextcord
-from dataclasses_json import dataclass_json
 from nextcord.ext import commands
 from nextcord.utils import get, utcnow, format_dt
 
+import codec
+import persistence
+import scheduling
 import utility
+from codec import serializable
 
 not_voted_yet = "-"
 confirmed_yes_vote = "confirmed_yes_vote"
@@ -22,9 +28,19 @@ confirmed_no_vote = "confirmed_no_vote"
 voted_yes_emoji = '\U00002705'  # ✅
 voted_no_emoji = '\U0000274C'  # ❌
 clock_emoji = '\U0001f566'  # 🕦
-
-
-@dataclass_json
+TownSquaresStore = "townsquares"
+NominationHistoryStore = "nomination_history"
+TownSquareIndexStore = "townsquare_index"
+VoteCountsStore = "vote_counts"
+NominationRenderDelay = 2.0  # seconds
+MaxRememberedRenders = 500
+LogFlushDelay = 3.0  # seconds
+# votes that "Lock clear votes" counts without asking, compared after lowercasing and stripping punctuation
+clear_yes_votes = {"yes", "y", "yea", "yeah", "yep", "aye", "+", "+1", voted_yes_emoji, '\U0001F44D'}  # 👍
+clear_no_votes = {"no", "n", "nay", "nope", "-1", voted_no_emoji, '\U0001F44E'}  # 👎
+
+
+@serializable
 @dataclass
 class Player:
     id: int
@@ -36,7 +52,7 @@ class Player:
         return isinstance(other, (Player, nextcord.User, nextcord.Member)) and self.id == other.id
 
 
-@dataclass_json
+@serializable
 @dataclass
 class Vote:
     vote: str
@@ -44,21 +60,29 @@ class Vote:
     thief: bool = False
 
 
-@dataclass_json
+@serializable
 @dataclass
 class Nomination:
     nominator: Player
     nominee: Player
     votes: Dict[int, Vote]
-    deadline: str
+    deadline: int  # seconds since the epoch
     private_votes: Dict[int, str] = field(default_factory=dict)
     accusation: str = "TBD"
     defense: str = "TBD"
     message: int = None
     finished: bool = False
+    warned: bool = False
+    expired: bool = False
+
+    def __post_init__(self):
+        if isinstance(self.deadline, str):
+            # stored as a formatted Discord timestamp, <t:1700000000:R>, by older versions
+            match = re.search(r"\d+", self.deadline)
+            self.deadline = int(match.group()) if match else 0
 
 
-@dataclass_json
+@serializable
 @dataclass
 class TownSquare:
     players: List[Player]
@@ -72,25 +96,123 @@ class TownSquare:
     vote_threshold: int = 0
 
 
+@serializable
+@dataclass
+class NominationDeadline:
+    message: int
+    deadline: int  # seconds since the epoch
+    warned: bool = False
+
+
+@serializable
+@dataclass
+class TownSquareIndexEntry:
+    # what is needed about a game without reading its shard
+    deadlines: List[NominationDeadline] = field(default_factory=list)
+    log_thread: int = None
+
+
+@serializable
+@dataclass
+class VoteCountSession:
+    # what is needed to pick a vote count back up after a restart
+    game: str
+    nomination: int
+    author: int
+    channel: int
+    message: int
+    player_index: int = -1
+
+
+def votes_needed(town_square: TownSquare) -> int:
+    if town_square.vote_threshold == 0:
+        return ceil(len([player for player in town_square.players if not player.dead]) / 2)
+    return town_square.vote_threshold
+
+
+def vote_weight(vote: Vote) -> int:
+    value = 1
+    if vote.thief:
+        value *= -1
+    if vote.bureaucrat:
+        value *= 3
+    return value
+
+
+class VoteTally:
+    """Seat order, threshold, clock position and running yes count of a nomination.
+    Built in one pass, then advanced in constant time as votes are locked in seat order. Any other change makes
+    record return False, and the tally is rebuilt on the next render."""
+    seats: List[Player]
+    seat_of: Dict[int, int]
+    threshold: int
+    counts: Dict[int, int]  # seat index of each counted yes vote -> running count including it
+    total: int
+    last_yes: int
+    position: int
+
+    def __init__(self, town_square: TownSquare, nom: Nomination):
+        self.seats = reordered_players(nom, town_square)
+        self.seat_of = {player.id: seat for seat, player in enumerate(self.seats)}
+        self.threshold = votes_needed(town_square)
+        self.counts = {}
+        self.total = 0
+        self.last_yes = -1
+        for seat, player in enumerate(self.seats):
+            vote = nom.votes[player.id]
+            if player.can_vote and vote.vote == confirmed_yes_vote:
+                self.count(seat, vote)
+        self.position = 0
+        self.advance(nom)
+
+    def count(self, seat: int, vote: Vote):
+        self.total += vote_weight(vote)
+        self.counts[seat] = self.total
+        self.last_yes = seat
+
+    def is_open(self, nom: Nomination, seat: int) -> bool:
+        player = self.seats[seat]
+        return player.can_vote and nom.votes[player.id].vote not in [confirmed_yes_vote, confirmed_no_vote]
+
+    def advance(self, nom: Nomination):
+        while self.position < len(self.seats) and not self.is_open(nom, self.position):
+            self.position += 1
+
+    def current_voter(self) -> Optional[Player]:
+        return self.seats[self.position] if self.position < len(self.seats) else None
+
+    def record(self, nom: Nomination, player_id: int) -> bool:
+        seat = self.seat_of.get(player_id)
+        if seat is None or seat < self.position:
+            return False
+        vote = nom.votes[player_id].vote
+        if seat == self.position:
+            if vote == confirmed_no_vote:
+                self.advance(nom)
+                return True
+            if vote == confirmed_yes_vote and seat > self.last_yes:
+                self.count(seat, nom.votes[player_id])
+                self.advance(nom)
+                return True
+            return vote not in [confirmed_yes_vote, confirmed_no_vote]
+        # a vote further round the circle only matters once it is a counted yes or stops being one
+        return seat not in self.counts and vote != confirmed_yes_vote
+
+
 def format_nom_message(game_role: nextcord.Role, town_square: TownSquare, nom: Nomination,
-                       emoji: Dict[str, nextcord.PartialEmoji]) -> (
+                       emoji: Dict[str, nextcord.PartialEmoji], tally: Optional[VoteTally] = None) -> (
         str, nextcord.Embed):
-    if town_square.vote_threshold == 0:
-        votes_needed = ceil(len([player for player in town_square.players if not player.dead]) / 2)
-    else:
-        votes_needed = town_square.vote_threshold
-    players = reordered_players(nom, town_square)
-    current_voter = next((player for player in players if player.can_vote and
-                          nom.votes[player.id].vote not in [confirmed_yes_vote, confirmed_no_vote]), None)
+    if tally is None:
+        tally = VoteTally(town_square, nom)
+    current_voter = tally.current_voter()
     content = f"{game_role.mention} {nom.nominator.alias} has nominated {nom.nominee.alias}.\n" \
               f"Accusation: {nom.accusation}\n" \
               f"Defense: {nom.defense}\n" \
-              f"Votes close {nom.deadline}. " \
-              f"{votes_needed} votes required to put {nom.nominee.alias} on the block.\n"
+              f"Votes {'closed' if nom.expired else 'close'} {deadline_timestamp(nom)}. " \
+              f"{tally.threshold} votes required to put {nom.nominee.alias} on the block.\n"
     embed = nextcord.Embed(title="Votes",
                            color=0xff0000)
-    counter = 0
-    for player in players:
+    for seat, player in enumerate(tally.seats):
         name = player.alias + " (Nominator)" if player == nom.nominator else player.alias
         if player.dead:
             name = str(emoji["shroud"]) + " " + name
@@ -105,14 +227,8 @@ def format_nom_message(game_role: nextcord.Role, town_square: TownSquare, nom: N
                                 value=str(emoji["organ_grinder"]),
                                 inline=False)
             elif vote.vote == confirmed_yes_vote:
-                value = 1
-                if vote.thief:
-                    value *= -1
-                if vote.bureaucrat:
-                    value *= 3
-                counter += value
                 embed.add_field(name=name,
-                                value=f"{voted_yes_emoji} ({counter}/{votes_needed})",
+                                value=f"{voted_yes_emoji} ({tally.counts[seat]}/{tally.threshold})",
                                 inline=False)
             elif vote.vote == confirmed_no_vote:
                 embed.add_field(name=name,
@@ -125,6 +241,20 @@ def format_nom_message(game_role: nextcord.Role, town_square: TownSquare, nom: N
     return content, embed
 
 
+def deadline_timestamp(nom: Nomination) -> str:
+    return format_dt(datetime.datetime.fromtimestamp(nom.deadline, datetime.timezone.utc), "R")
+
+
+def classify_vote(vote: str) -> Optional[str]:
+    # confirmed_yes_vote or confirmed_no_vote if the vote can only mean that, None if the ST has to decide
+    normalized = vote.strip().lower().rstrip(".!")
+    if normalized in clear_yes_votes:
+        return confirmed_yes_vote
+    if normalized in clear_no_votes:
+        return confirmed_no_vote
+    return None
+
+
 def reordered_players(nom: Nomination, town_square: TownSquare) -> List[Player]:
     if nom.nominee in town_square.players:
         last_vote_index = next(i for i, player in enumerate(town_square.players) if player == nom.nominee)
@@ -135,28 +265,465 @@ def reordered_players(nom: Nomination, town_square: TownSquare) -> List[Player]:
     return town_square.players[last_vote_index + 1:] + town_square.players[:last_vote_index + 1]
 
 
+def index_entry(town_square: TownSquare) -> TownSquareIndexEntry:
+    return TownSquareIndexEntry([NominationDeadline(nom.message, nom.deadline, nom.warned)
+                                 for nom in town_square.nominations if not nom.finished and not nom.expired],
+                                town_square.log_thread)
+
+
+def event_loop_running() -> bool:
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        # e.g. a maintenance script working on the storage
+        return False
+
+
+class TownSquareStore(MutableMapping[str, TownSquare]):
+    # one shard per game, each loaded on first access and only rewritten when that game changes.
+    # Finished nominations are moved to a separate history shard, which is only loaded when something is archived.
+    # On the event loop, shards are read with load and load_history, so reading never blocks it.
+    # A small index document keeps what is needed about every game at startup, e.g. the deadlines to schedule
+    shard_name_pattern = re.compile(r"^[\w-]+$")
+
+    def __init__(self, storage: persistence.Persistence, directory: str, journal: str, history_directory: str,
+                 index_path: str):
+        self.storage = storage
+        # registered first, so the index and archived nominations are written before the journal is emptied
+        storage.register_document(TownSquareIndexStore, index_path, self.serialize_index)
+        storage.register_shards(NominationHistoryStore, history_directory, self.serialize_history)
+        storage.register_shards(TownSquaresStore, directory, self.serialize, journal)
+        self.games: Dict[str, Optional[TownSquare]] = {game: None for game in storage.shard_keys(TownSquaresStore)}
+        self.histories: Dict[str, Optional[List[Nomination]]] = \
+            {game: None for game in storage.shard_keys(NominationHistoryStore)}
+        self.loads: Dict[str, asyncio.Future] = {}
+        self.history_loads: Dict[str, asyncio.Task] = {}
+        self.index: Dict[str, TownSquareIndexEntry] = {}
+        index = storage.load_document(TownSquareIndexStore)
+        if index is None:
+            self.rebuild_index()
+        else:
+            self.index = {game: TownSquareIndexEntry.from_dict(entry) for game, entry in index.items()
+                          if game in self.games}
+
+    async def load(self, game_number: str) -> TownSquare:
+        """Returns the town square, reading its shard first if necessary. Concurrent loads share one read."""
+        if self.games[game_number] is None:
+            read = self.loads.get(game_number)
+            if read is None:
+                read = asyncio.ensure_future(self.storage.fetch_shard(TownSquaresStore, game_number))
+                self.loads[game_number] = read
+            try:
+                data = await read
+            finally:
+                self.loads.pop(game_number, None)
+            # the game may have been loaded by another waiter, replaced or removed in the meantime
+            if self.games[game_number] is None:
+                self.loaded(game_number, data)
+        return self.games[game_number]
+
+    def loaded(self, game_number: str, data: dict) -> TownSquare:
+        town_square = TownSquare.from_dict(data)
+        self.games[game_number] = town_square
+        logging.debug(f"Loaded town square shard for game {game_number}")
+        if any(nom.finished for nom in town_square.nominations):
+            # stored before finished nominations were kept separately
+            self.archive_finished(game_number)
+            self.mark_dirty(game_number)
+        return town_square
+
+    def __getitem__(self, game_number: str) -> TownSquare:
+        town_square = self.games[game_number]
+        if town_square is None:
+            # blocks until the shard is read, which is only acceptable while the cog is loading
+            town_square = self.loaded(game_number, self.storage.load_shard(TownSquaresStore, game_number))
+        return town_square
+
+    def __setitem__(self, game_number: str, town_square: TownSquare):
+        if self.shard_name_pattern.match(game_number) is None:
+            raise ValueError(f"Invalid game number for town square storage: {game_number}")
+        self.games[game_number] = town_square
+        self.mark_dirty(game_number)
+
+    def __delitem__(self, game_number: str):
+        del self.games[game_number]
+        self.index.pop(game_number, None)
+        self.mark_dirty(game_number)
+        if game_number in self.histories:
+            del self.histories[game_number]
+            self.mark_history_dirty(game_number)
+
+    def __contains__(self, game_number) -> bool:
+        return game_number in self.games
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.games)
+
+    def __len__(self) -> int:
+        return len(self.games)
+
+    def discard(self, game_number: str):
+        # unlike pop, this doesn't read the shard of the game that is being removed
+        if game_number in self.games:
+            del self[game_number]
+
+    def mark_dirty(self, game_number: str):
+        self.storage.mark_dirty(TownSquaresStore, game_number)
+        self.storage.mark_dirty(TownSquareIndexStore)
+
+    def serialize(self, game_number: str) -> Optional[dict]:
+        return self[game_number].to_dict() if game_number in self.games else None
+
+    def index_entry(self, game_number: str) -> Optional[TownSquareIndexEntry]:
+        # loaded games may have changed since the index was written, the others haven't
+        town_square = self.games[game_number]
+        return index_entry(town_square) if town_square is not None else self.index.get(game_number)
+
+    def serialize_index(self) -> dict:
+        entries = {game: self.index_entry(game) for game in self.games}
+        return {game: entry.to_dict() for game, entry in entries.items() if entry is not None}
+
+    def rebuild_index(self):
+        # stored before the index existed, so every shard is read once
+        self.index = {game: index_entry(self[game]) for game in self.games}
+        self.storage.mark_dirty(TownSquareIndexStore)
+        if self.index:
+            logging.warning(f"Rebuilt the town square index for {len(self.index)} games")
+
+    def history(self, game_number: str) -> List[Nomination]:
+        history = self.histories.get(game_number)
+        if history is None:
+            data = self.storage.load_shard(NominationHistoryStore, game_number) if game_number in self.histories \
+                else None
+            history = [Nomination.from_dict(nom) for nom in data or []]
+            self.histories[game_number] = history
+        return history
+
+    def history_loaded(self, game_number: str) -> bool:
+        return self.histories.get(game_number) is not None or game_number not in self.histories
+
+    async def load_history(self, game_number: str):
+        try:
+            data = await self.storage.fetch_shard(NominationHistoryStore, game_number)
+            if not self.history_loaded(game_number):
+                self.histories[game_number] = [Nomination.from_dict(nom) for nom in data or []]
+        finally:
+            self.history_loads.pop(game_number, None)
+        if self.games.get(game_number) is not None:
+            self.archive_finished(game_number)
+            self.mark_dirty(game_number)
+
+    def archive_finished(self, game_number: str):
+        town_square = self.games[game_number]
+        if not any(nom.finished for nom in town_square.nominations):
+            return
+        if not self.history_loaded(game_number) and event_loop_running():
+            # the finished nominations stay in the game's shard until the stored history has been read
+            if game_number not in self.history_loads:
+                self.history_loads[game_number] = asyncio.create_task(self.load_history(game_number))
+            return
+        finished = [nom for nom in town_square.nominations if nom.finished]
+        town_square.nominations = [nom for nom in town_square.nominations if not nom.finished]
+        history = self.history(game_number)
+        for nom in finished:
+            # after a crash the journal can replay a nomination that already made it into the history
+            if find_nomination(history, nom.message) is None:
+                history.append(nom)
+        self.mark_history_dirty(game_number)
+
+    def find_archived(self, game_number: str, message_id: int) -> Optional[Nomination]:
+        return find_nomination(self.history(game_number), message_id)
+
+    def mark_history_dirty(self, game_number: str):
+        self.storage.mark_dirty(NominationHistoryStore, game_number)
+
+    def serialize_history(self, game_number: str) -> Optional[list]:
+        if game_number not in self.games or not self.histories.get(game_number):
+            return None
+        return [nom.to_dict() for nom in self.histories[game_number]]
+
+    def import_shard(self, game_number: str, data: dict):
+        self.storage.write_shard(TownSquaresStore, game_number, data)
+        self.games[game_number] = None
+        self.index[game_number] = index_entry(TownSquare.from_dict(data))
+        self.storage.mark_dirty(TownSquareIndexStore)
+
+
+def find_nomination(nominations: List[Nomination], message_id: int) -> Optional[Nomination]:
+    return next((n for n in nominations if n.message == message_id), None)
+
+
+class NominationIndex:
+    """The open nominations of a game by nominee and by nominator. Discarded whenever nominations are added,
+    finished or the town square is replaced."""
+    by_nominee: Dict[int, Nomination]
+    by_nominator: Dict[int, Nomination]
+
+    def __init__(self, nominations: List[Nomination]):
+        self.by_nominee = {}
+        self.by_nominator = {}
+        for nom in nominations:
+            if not nom.finished:
+                self.by_nominee.setdefault(nom.nominee.id, nom)
+                self.by_nominator.setdefault(nom.nominator.id, nom)
+
+
+class ParticipantIndex:
+    """Aliases, display names and usernames of a game's participants, lowercased up front, and the participant each
+    looked up identifier resolved to. Discarded whenever one of the names changes."""
+    ids: List[int]
+    names: List[List[str]]
+    lowered: List[List[str]]
+    resolved: Dict[str, Optional[int]]
+    max_resolved = 256
+
+    def __init__(self, participants: List[Player], members: Dict[int, Optional[nextcord.Member]]):
+        self.ids = [p.id for p in participants]
+        # participants that left the server can still be found by alias
+        self.names = [[p.alias for p in participants],
+                      [members[p.id].display_name if members[p.id] else "" for p in participants],
+                      [members[p.id].name if members[p.id] else "" for p in participants]]
+        self.lowered = [[name.lower() for name in names] for names in self.names]
+        self.resolved = {}
+
+    def matches(self, kind: int, identifier: str) -> List[int]:
+        names = self.names[kind]
+        lowered = self.lowered[kind]
+        lower_identifier = identifier.lower()
+        matches = [i for i, name in zip(self.ids, lowered) if lower_identifier in name]
+        if len(matches) > 1:
+            matches = [i for i, name in zip(self.ids, lowered) if name.startswith(lower_identifier)]
+            if len(matches) < 1:
+                matches = [i for i, name in zip(self.ids, names) if identifier in name]
+            elif len(matches) > 1:
+                matches = [i for i, name in zip(self.ids, names) if name.startswith(identifier)]
+                if len(matches) < 1:
+                    matches = [i for i, name in zip(self.ids, lowered) if name == lower_identifier]
+                elif len(matches) > 1:
+                    matches = [i for i, name in zip(self.ids, names) if name == identifier]
+        return matches
+
+    def resolve(self, identifier: str) -> Optional[int]:
+        if identifier not in self.resolved:
+            if len(self.resolved) >= self.max_resolved:
+                self.resolved.clear()
+            self.resolved[identifier] = self.find(identifier)
+        return self.resolved[identifier]
+
+    def find(self, identifier: str) -> Optional[int]:
+        alias_matches = self.matches(0, identifier)
+        if len(alias_matches) == 1:
+            return alias_matches[0]
+        display_name_matches = self.matches(1, identifier)
+        username_matches = self.matches(2, identifier)
+        if len(alias_matches) > 1:
+            if len(set(alias_matches).intersection(set(display_name_matches))) == 1:
+                return list(set(alias_matches).intersection(set(display_name_matches)))[0]
+            elif len(set(alias_matches).intersection(set(username_matches))) == 1:
+                return list(set(alias_matches).intersection(set(username_matches)))[0]
+            elif len(set(display_name_matches).intersection(set(username_matches))) == 1:
+                return list(set(display_name_matches).intersection(set(username_matches)))[0]
+            return None
+        elif len(display_name_matches) == 1:
+            return display_name_matches[0]
+        elif len(display_name_matches) > 1:
+            if len(set(display_name_matches).intersection(set(username_matches))) == 1:
+                return list(set(display_name_matches).intersection(set(username_matches)))[0]
+            return None
+        elif len(username_matches) == 1:
+            return username_matches[0]
+        return None
+
+
+def apply_journal_record(town_squares: TownSquareStore, record: dict):
+    # replays a single mutation written by Townsquare.journal on top of the loaded town squares
+    game_number = record["game"]
+    op = record["op"]
+    data = record.get("data")
+    if op == "town_square":
+        town_squares[game_number] = TownSquare.from_dict(data)
+        town_squares.archive_finished(game_number)
+        return
+    if op == "delete":
+        town_squares.discard(game_number)
+        return
+    town_square = town_squares[game_number]
+    if op == "settings":
+        for key, value in data.items():
+            setattr(town_square, key, value)
+    elif op == "player":
+        player = next((p for p in town_square.players + town_square.sts if p.id == data["id"]), None)
+        if player is not None:
+            for key, value in data.items():
+                setattr(player, key, value)
+    elif op == "nomination":
+        nom = Nomination.from_dict(data)
+        existing = find_nomination(town_square.nominations, nom.message)
+        if existing is None:
+            town_square.nominations.append(nom)
+        else:
+            town_square.nominations[town_square.nominations.index(existing)] = nom
+        town_squares.archive_finished(game_number)
+    elif op == "vote":
+        nom = find_journaled_nomination(town_squares, game_number, record["nomination"])
+        nom.votes[record["player"]] = Vote.from_dict(data)
+    elif op == "private_vote":
+        nom = find_journaled_nomination(town_squares, game_number, record["nomination"])
+        if data is None:
+            nom.private_votes.pop(record["player"], None)
+        else:
+            nom.private_votes[record["player"]] = data
+    else:
+        raise ValueError(f"Unknown journal operation {op}")
+
+
+def find_journaled_nomination(town_squares: TownSquareStore, game_number: str, message_id: int) -> Nomination:
+    nom = find_nomination(town_squares[game_number].nominations, message_id)
+    if nom is None:
+        # votes can still be locked through a vote count that was open when the nomination was closed
+        nom = town_squares.find_archived(game_number, message_id)
+        town_squares.mark_history_dirty(game_number)
+    return nom
+
+
 class Townsquare(commands.Cog):
     bot: commands.Bot
     helper: utility.Helper
     TownSquaresStorage: str
-    town_squares: Dict[str, TownSquare]
+    TownSquaresJournal: str
+    town_squares: TownSquareStore
     emoji: Dict[str, nextcord.PartialEmoji]
     vote_count_views: List[CountVoteView]
+    participant_indexes: Dict[str, ParticipantIndex]
+    nomination_indexes: Dict[str, NominationIndex]
+    tallies: Dict[str, Dict[int, VoteTally]]
+    game_locks: Dict[str, asyncio.Lock]
+    command_locks: Dict[int, asyncio.Lock]
+    render_semaphores: Dict[str, asyncio.Semaphore]
+    deadline_timer: scheduling.HeapTimer
+    pending_renders: Dict[int, Tuple[str, Nomination]]
+    render_tasks: Dict[int, asyncio.Task]
+    rendered_noms: OrderedDict[int, Tuple[str, dict]]
+    nom_threads: Dict[str, nextcord.Thread]
+    nom_messages: Dict[int, nextcord.PartialMessage]
+    log_threads: Dict[str, nextcord.Thread]
+    log_thread_ids: Set[int]
+    log_buffers: Dict[str, List[str]]
+    log_tasks: Dict[str, asyncio.Task]
 
     def __init__(self, bot: commands.Bot, helper: utility.Helper):
         self.bot = bot
         self.helper = helper
-        self.TownSquaresStorage = os.path.join(self.helper.StorageLocation, "townsquares.json")
+        self.TownSquaresStorage = os.path.join(self.helper.StorageLocation, "townsquares")
+        self.TownSquaresJournal = os.path.join(self.helper.StorageLocation, "townsquares.journal")
+        self.NominationHistoryStorage = os.path.join(self.helper.StorageLocation, "nomination_history")
+        self.VoteCountsStorage = os.path.join(self.helper.StorageLocation, "vote_counts.json")
+        self.TownSquareIndexStorage = os.path.join(self.helper.StorageLocation, "townsquare_index.json")
         self.emoji = {}
         self.vote_count_views = []
-        self.town_squares = {}
-        if not os.path.exists(self.TownSquaresStorage):
-            self.update_storage()
-        else:
-            with open(self.TownSquaresStorage, 'r') as f:
-                json_data = json.load(f)
-                for game in json_data:
-                    self.town_squares[game] = TownSquare.from_dict(json_data[game])
+        self.participant_indexes = {}
+        self.nomination_indexes = {}
+        self.tallies = {}
+        self.game_locks = {}
+        self.command_locks = {}
+        self.render_semaphores = {}
+        self.deadline_timer = scheduling.HeapTimer(self.on_deadline_timer)
+        self.pending_renders = {}
+        self.render_tasks = {}
+        self.rendered_noms = OrderedDict()
+        self.nom_threads = {}
+        self.nom_messages = {}
+        self.log_threads = {}
+        self.log_thread_ids = set()
+        self.log_buffers = {}
+        self.log_tasks = {}
+        self.town_squares = TownSquareStore(self.helper.Persistence, self.TownSquaresStorage, self.TownSquaresJournal,
+                                            self.NominationHistoryStorage, self.TownSquareIndexStorage)
+        self.migrate_single_file_storage()
+        self.replay_journal()
+        self.update_log_thread_ids()
+        self.helper.Persistence.register_document(VoteCountsStore, self.VoteCountsStorage, self.serialize_vote_counts)
+
+    def cog_unload(self):
+        for view in self.vote_count_views:
+            # the reloaded cog registers its own views for the same messages
+            view.stop()
+        self.deadline_timer.stop()
+        # whatever the debounce tasks were waiting for is sent right away instead
+        for task in list(self.log_tasks.values()) + list(self.render_tasks.values()):
+            task.cancel()
+        self.log_tasks.clear()
+        self.render_tasks.clear()
+        if self.log_buffers or self.pending_renders:
+            asyncio.create_task(self.flush())
+        self.helper.Persistence.unregister(TownSquareIndexStore)
+        self.helper.Persistence.unregister(TownSquaresStore)
+        self.helper.Persistence.unregister(NominationHistoryStore)
+        self.helper.Persistence.unregister(VoteCountsStore)
+
+    def serialize_vote_counts(self) -> list:
+        return [view.session().to_dict() for view in self.vote_count_views if not view.nom.finished]
+
+    def store_vote_counts(self):
+        self.helper.Persistence.mark_dirty(VoteCountsStore)
+
+    async def restore_vote_counts(self):
+        # vote counts are persistent views, so counting continues on the same message after a restart
+        sessions = [VoteCountSession.from_dict(session) for session in
+                    self.helper.Persistence.load_document(VoteCountsStore) or []]
+        for session in sessions:
+            if session.game not in self.town_squares:
+                continue
+            town_square = await self.town_squares.load(session.game)
+            nom = find_nomination(town_square.nominations, session.nomination)
+            author = await self.helper.Members.fetch(session.author)
+            channel = self.bot.get_channel(session.channel) or self.helper.Guild.get_thread(session.channel)
+            if channel is None:
+                try:
+                    channel = await self.bot.fetch_channel(session.channel)
+                except nextcord.HTTPException:
+                    channel = None
+            if nom is None or author is None or channel is None:
+                logging.warning(f"Dropping vote count {session.message} in game {session.game}, its nomination, "
+                                f"author or channel is gone")
+                continue
+            view = CountVoteView(self, nom, author, session.game, self.emoji, session.player_index)
+            view.message = channel.get_partial_message(session.message)
+            self.bot.add_view(view, message_id=session.message)
+            self.vote_count_views.append(view)
+        if len(self.vote_count_views) != len(sessions):
+            self.store_vote_counts()
+        logging.info(f"Restored {len(self.vote_count_views)} vote counts")
+
+    def migrate_single_file_storage(self):
+        # older versions kept every game in a single townsquares.json
+        old_storage = os.path.join(self.helper.StorageLocation, "townsquares.json")
+        json_data = self.helper.Persistence.load(old_storage)
+        if json_data is None:
+            return
+        for game in json_data:
+            if game not in self.town_squares:
+                self.town_squares.import_shard(game, json_data[game])
+        self.helper.Persistence.run(os.replace, old_storage, old_storage + ".migrated")
+        logging.warning(f"Migrated {len(json_data)} town squares to per-game storage in {self.TownSquaresStorage}")
+
+    def replay_journal(self):
+        lines = self.helper.Persistence.read_journal(TownSquaresStore)
+        if not lines:
+            return
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = codec.loads(line)
+                apply_journal_record(self.town_squares, record)
+                self.town_squares.mark_dirty(record["game"])
+            except (ValueError, KeyError, AttributeError) as e:
+                # a crash while appending can leave a partial final line - everything before it is still valid
+                logging.error(f"Skipping unreadable town square journal record: {line.strip()[:200]} ({e})")
+        # the replayed games are now marked dirty, so the journal is dropped once their shards have been written
+        logging.info(f"Replayed {len(lines)} town square journal records")
 
     async def load_emoji(self):
         self.emoji = {}
@@ -165,103 +732,464 @@ class Townsquare(commands.Cog):
             self.emoji["shroud"] = nextcord.PartialEmoji.from_str('{emoji.name}:{emoji.id}'.format(emoji=shroud_emoji))
         else:
             self.emoji["shroud"] = nextcord.PartialEmoji.from_str('\U0001F480')  # 💀
-            await self.helper.log("Shroud emoji not found, using default")
+            await self.helper.log("Shroud emoji not found, using default", logging.WARNING)
         thief_emoji = get(self.helper.Guild.emojis, name="thief")
         if thief_emoji is not None:
             self.emoji["thief"] = nextcord.PartialEmoji.from_str('{emoji.name}:{emoji.id}'.format(emoji=thief_emoji))
         else:
             self.emoji["thief"] = nextcord.PartialEmoji.from_str('\U0001F48E')  # 💎
-            await self.helper.log("Thief emoji not found, using default")
+            await self.helper.log("Thief emoji not found, using default", logging.WARNING)
         bureaucrat_emoji = get(self.helper.Guild.emojis, name="bureaucrat")
         if bureaucrat_emoji is not None:
             self.emoji["bureaucrat"] = nextcord.PartialEmoji.from_str(
                 '{emoji.name}:{emoji.id}'.format(emoji=bureaucrat_emoji))
         else:
             self.emoji["bureaucrat"] = nextcord.PartialEmoji.from_str('\U0001f4ce')  # 📎
-            await self.helper.log("Bureaucrat emoji not found, using default")
+            await self.helper.log("Bureaucrat emoji not found, using default", logging.WARNING)
         organ_grinder_emoji = get(self.helper.Guild.emojis, name="organ_grinder")
         if organ_grinder_emoji is not None:
             self.emoji["organ_grinder"] = nextcord.PartialEmoji.from_str(
                 '{emoji.name}:{emoji.id}'.format(emoji=organ_grinder_emoji))
         else:
             self.emoji["organ_grinder"] = nextcord.PartialEmoji.from_str('\U0001f648')  # 🙈
-            await self.helper.log("Organ grinder emoji not found, using default")
+            await self.helper.log("Organ grinder emoji not found, using default", logging.WARNING)
+
+    def journal(self, game_number: str, op: str, data=None, **keys):
+        # the record makes the change durable right away, the game's shard is rewritten once writes are coalesced
+        record = {"game": game_number, "op": op, **keys, "data": data}
+        self.helper.Persistence.append(TownSquaresStore, record)
+        self.town_squares.mark_dirty(game_number)
+
+    def journal_town_square(self, game_number: str):
+        # the town square was replaced or its participants changed
+        self.forget_participants(game_number)
+        self.forget_nominations(game_number)
+        self.forget_tallies(game_number)
+        self.journal(game_number, "town_square", self.town_squares[game_number].to_dict())
+        self.town_squares.archive_finished(game_number)
+        self.deadline_timer.cancel_where(lambda key: key[0] == game_number)
+        for nom in self.town_squares[game_number].nominations:
+            self.schedule_deadline(game_number, nom)
+        self.update_log_thread_ids()
+
+    def journal_delete(self, game_number: str):
+        self.forget_participants(game_number)
+        self.forget_nominations(game_number)
+        self.forget_tallies(game_number)
+        self.forget_output(game_number)
+        self.deadline_timer.cancel_where(lambda key: key[0] == game_number)
+        # whoever holds or waits for the lock keeps their reference, the next command for the game makes a new one
+        self.game_locks.pop(game_number, None)
+        self.render_semaphores.pop(game_number, None)
+        self.journal(game_number, "delete")
+        self.update_log_thread_ids()
+
+    def update_log_thread_ids(self):
+        # taken from the index, so other cogs can recognize log threads without any game's shard being read
+        entries = [self.town_squares.index_entry(game_number) for game_number in self.town_squares]
+        self.log_thread_ids = {entry.log_thread for entry in entries if entry is not None and entry.log_thread}
+
+    def journal_settings(self, game_number: str, *fields: str):
+        town_square = self.town_squares[game_number]
+        self.forget_tallies(game_number)
+        self.journal(game_number, "settings", {key: getattr(town_square, key) for key in fields})
+
+    def journal_player(self, game_number: str, player: Player):
+        self.forget_tallies(game_number)
+        self.journal(game_number, "player", player.to_dict())
+
+    def journal_nomination(self, game_number: str, nom: Nomination):
+        index = self.nomination_indexes.get(game_number)
+        if nom.finished or (index is not None and index.by_nominee.get(nom.nominee.id) is not nom):
+            self.forget_nominations(game_number)
+        if nom.finished:
+            self.tallies.get(game_number, {}).pop(nom.message, None)
+        self.journal(game_number, "nomination", nom.to_dict())
+        if nom.finished:
+            # journaled first, so a crash before the history is written replays the nomination into it again
+            self.town_squares.archive_finished(game_number)
+        self.schedule_deadline(game_number, nom)
+
+    def start_deadline_timer(self):
+        # scheduled from the index, so no shard is read - on_deadline_timer loads the game once a timer is due
+        for game_number in self.town_squares:
+            entry = self.town_squares.index_entry(game_number)
+            for deadline in entry.deadlines if entry is not None else []:
+                self.schedule_deadline_timers(game_number, deadline)
+        self.deadline_timer.start()
+
+    def schedule_deadline(self, game_number: str, nom: Nomination):
+        if nom.finished or nom.expired:
+            self.deadline_timer.cancel((game_number, nom.message, "warning"))
+            self.deadline_timer.cancel((game_number, nom.message, "deadline"))
+        else:
+            self.schedule_deadline_timers(game_number, NominationDeadline(nom.message, nom.deadline, nom.warned))
+
+    def schedule_deadline_timers(self, game_number: str, nom: NominationDeadline):
+        # a nomination has up to two timer entries: the ping for players that have not voted yet, and the deadline
+        warning_key = (game_number, nom.message, "warning")
+        deadline_key = (game_number, nom.message, "deadline")
+        self.deadline_timer.schedule(deadline_key, nom.deadline)
+        warning_time = nom.deadline - self.helper.Config.nomination_warning_hours * 3600
+        # a deadline set closer than the warning period gets no warning, rather than pinging everyone right away
+        if nom.warned or self.helper.Config.nomination_warning_hours <= 0 or warning_time <= time.time():
+            self.deadline_timer.cancel(warning_key)
+        else:
+            self.deadline_timer.schedule(warning_key, warning_time)
 
-    def update_storage(self):
-        json_data = {}
-        for game in self.town_squares:
-            json_data[game] = self.town_squares[game].to_dict()
-        with open(self.TownSquaresStorage, 'w') as f:
-            json.dump(json_data, f, indent=2)
+    async def on_deadline_timer(self, key: Tuple[str, int, str]):
+        game_number, message_id, kind = key
+        async with self.game_lock(game_number):
+            if game_number not in self.town_squares:
+                return
+            town_square = await self.town_squares.load(game_number)
+            nom = find_nomination(town_square.nominations, message_id)
+            if nom is None or nom.finished or nom.expired:
+                return
+            if kind == "warning":
+                nom.warned = True
+                self.journal_nomination(game_number, nom)
+                await self.ping_missing_voters(game_number, nom)
+            else:
+                nom.expired = True
+                self.journal_nomination(game_number, nom)
+                await self.update_nom_message(game_number, nom)
+                await self.log(game_number, f"{self.st_mention(game_number)} The deadline for the nomination of "
+                                            f"{nom.nominee.alias} has passed.")
+
+    async def ping_missing_voters(self, game_number: str, nom: Nomination):
+        nom_thread = self.get_nom_thread(game_number)
+        missing = [player for player in self.town_squares[game_number].players if player.can_vote and
+                   nom.votes[player.id].vote == not_voted_yet and player.id not in nom.private_votes]
+        if nom_thread is None or not missing:
+            return
+        await nom_thread.send(f"{' '.join(f'<@{player.id}>' for player in missing)} the nomination of "
+                              f"{nom.nominee.alias} closes {deadline_timestamp(nom)} and you have not voted yet.")
+
+    def journal_vote(self, game_number: str, nom: Nomination, player_id: int):
+        tally = self.tallies.get(game_number, {}).get(nom.message)
+        if tally is not None and not tally.record(nom, player_id):
+            del self.tallies[game_number][nom.message]
+        self.journal(game_number, "vote", nom.votes[player_id].to_dict(), nomination=nom.message, player=player_id)
+        if nom.finished:
+            self.town_squares.mark_history_dirty(game_number)
+
+    def journal_private_vote(self, game_number: str, nom: Nomination, player_id: int):
+        self.journal(game_number, "private_vote", nom.private_votes.get(player_id), nomination=nom.message,
+                     player=player_id)
+        if nom.finished:
+            self.town_squares.mark_history_dirty(game_number)
 
     async def log(self, game_number: str, message: str):
-        kibitz = self.helper.get_kibitz_channel(game_number)
-        log_thread = get(kibitz.threads, id=self.town_squares[game_number].log_thread)
-        await log_thread.send((format_dt(utcnow()) + ": " + message)[:2000])
+        # lines are collected for LogFlushDelay and then sent in as few messages as possible
+        self.log_buffers.setdefault(game_number, []).append((format_dt(utcnow()) + ": " + message)[:2000])
+        if game_number not in self.log_tasks:
+            self.log_tasks[game_number] = asyncio.create_task(self.write_log(game_number))
+
+    async def write_log(self, game_number: str):
+        try:
+            while game_number in self.log_buffers:
+                await asyncio.sleep(LogFlushDelay)
+                try:
+                    await self.flush_log(game_number)
+                except Exception as e:
+                    logging.exception(f"Failed to write to the log thread of game {game_number}: {e}")
+        finally:
+            if self.log_tasks.get(game_number) is asyncio.current_task():
+                del self.log_tasks[game_number]
+
+    async def flush_log(self, game_number: str):
+        lines = self.log_buffers.pop(game_number, [])
+        if not lines:
+            return
+        log_thread = self.get_log_thread(game_number)
+        if log_thread is None:
+            logging.warning(f"Log thread for game {game_number} not found, dropping {len(lines)} lines")
+            return
+        for message in utility.pack_lines(lines):
+            await log_thread.send(message)
+
+    async def flush(self):
+        """Sends everything still waiting to be written. Called when the bot shuts down or the cog is unloaded."""
+        for game_number in list(self.log_buffers):
+            try:
+                await self.flush_log(game_number)
+            except Exception as e:
+                logging.exception(f"Failed to write to the log thread of game {game_number}: {e}")
+        for message_id in list(self.pending_renders):
+            entry = self.pending_renders.pop(message_id, None)
+            if entry is None:
+                continue
+            game_number, nom = entry
+            try:
+                await self.edit_nom_message(game_number, nom)
+            except Exception as e:
+                logging.exception(f"Failed to update nomination message {message_id} in game {game_number}: {e}")
+
+    def forget_output(self, game_number: str):
+        # log lines and renders still waiting for a game that no longer exists are dropped
+        self.log_buffers.pop(game_number, None)
+        task = self.log_tasks.pop(game_number, None)
+        if task is not None:
+            task.cancel()
+        for message_id in [m for m, (game, _) in self.pending_renders.items() if game == game_number]:
+            del self.pending_renders[message_id]
+            task = self.render_tasks.pop(message_id, None)
+            if task is not None:
+                task.cancel()
 
     async def update_nom_message(self, game_number: str, nom: Nomination):
-        game_role = self.helper.get_game_role(game_number)
-        content, embed = format_nom_message(game_role, self.town_squares[game_number], nom, self.emoji)
-        game_channel = self.helper.get_game_channel(game_number)
-        nom_thread = get(game_channel.threads, id=self.town_squares[game_number].nomination_thread)
+        # changes arriving in quick succession are rendered together, see render_nomination
+        self.pending_renders[nom.message] = (game_number, nom)
+        if nom.message not in self.render_tasks:
+            self.render_tasks[nom.message] = asyncio.create_task(self.render_nomination(nom.message))
+
+    async def render_nomination(self, message_id: int):
+        # edits a nomination message at most once per NominationRenderDelay, with whatever state is current by then
         try:
-            nom_message = await nom_thread.fetch_message(nom.message)
-            await nom_message.edit(content=content, embed=embed)
-        except nextcord.HTTPException as e:
-            if e.code == 10008:  # Discord's 404
-                logging.error(f"Missing message for nomination of {nom.nominee.alias} in game {game_number}")
-                st_role = self.helper.get_st_role(game_number)
-                await self.log(game_number, f"{st_role.mention} Could not find the nomination message for the "
-                                            f"nomination of {nom.nominee.alias} to update it. Please close the "
-                                            f"nomination to prevent this happening again.")
+            while message_id in self.pending_renders:
+                await asyncio.sleep(NominationRenderDelay)
+                entry = self.pending_renders.pop(message_id, None)
+                if entry is None:
+                    # update_nom_messages or flush rendered it while this was waiting
+                    break
+                game_number, nom = entry
+                try:
+                    await self.edit_nom_message(game_number, nom)
+                except Exception as e:
+                    logging.exception(f"Failed to update nomination message {message_id} in game {game_number}: {e}")
+        finally:
+            if self.render_tasks.get(message_id) is asyncio.current_task():
+                del self.render_tasks[message_id]
+
+    def render_semaphore(self, game_number: str) -> asyncio.Semaphore:
+        # all nomination messages of a game are in its nomination thread, so they share a rate limit bucket
+        semaphore = self.render_semaphores.get(game_number)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.helper.Config.nomination_render_concurrency)
+            self.render_semaphores[game_number] = semaphore
+        return semaphore
+
+    async def update_nom_messages(self, ctx: commands.Context, game_number: str, noms: List[Nomination]):
+        # for commands that change many nominations at once - renders them right away and concurrently,
+        # then reports everything that failed in a single message
+        noms = list(noms)
+        for nom in noms:
+            self.pending_renders.pop(nom.message, None)
+        results = await asyncio.gather(*[self.edit_nom_message(game_number, nom) for nom in noms],
+                                       return_exceptions=True)
+        failures = []
+        for nom, result in zip(noms, results):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to update nomination message {nom.message} in game {game_number}: {result}")
+                failures.append(f"{nom.nominee.alias}: {result}")
+        if failures:
+            await utility.dm_user(ctx.author, f"Could not update the nomination messages for "
+                                              f"{len(failures)} of {len(noms)} nominations:\n"
+                                              + "\n".join(failures)[:1800])
+
+    async def edit_nom_message(self, game_number: str, nom: Nomination):
+        game_role = self.helper.get_game_role(game_number)
+        content, embed = format_nom_message(game_role, self.town_squares[game_number], nom, self.emoji,
+                                            self.get_tally(game_number, nom))
+        rendered = (content, embed.to_dict())
+        if self.rendered_noms.get(nom.message) != rendered:
+            message = self.get_nom_message(game_number, nom)
+            if message is None:
+                await self.report_missing_nom_message(game_number, nom)
                 return
-            else:
-                raise e
+            try:
+                async with self.render_semaphore(game_number):
+                    await message.edit(content=content, embed=embed)
+            except nextcord.HTTPException as e:
+                self.nom_messages.pop(nom.message, None)
+                if e.code == 10008:  # Discord's 404
+                    await self.report_missing_nom_message(game_number, nom)
+                    return
+                else:
+                    raise e
+            self.rendered_noms[nom.message] = rendered
+            self.rendered_noms.move_to_end(nom.message)
+            if len(self.rendered_noms) > MaxRememberedRenders:
+                self.rendered_noms.popitem(last=False)
+            logging.debug(f"Updated nomination for game {game_number}: {nom}")
         view = next((v for v in self.vote_count_views if v.nom == nom), None)
         if view is not None:
             await view.update_message()
-        logging.debug(f"Updated nomination for game {game_number}: {nom}")
 
-    def get_game_participant(self, game_number: str, identifier: str) -> Union[nextcord.Member, None]:
+    def nomination_index(self, game_number: str) -> NominationIndex:
+        index = self.nomination_indexes.get(game_number)
+        # nominations finished while the town square is being updated are only archived afterwards
+        if index is None or any(nom.finished for nom in index.by_nominee.values()):
+            index = NominationIndex(self.town_squares[game_number].nominations)
+            self.nomination_indexes[game_number] = index
+        return index
+
+    def open_nomination(self, game_number: str, nominee_id: int) -> Optional[Nomination]:
+        return self.nomination_index(game_number).by_nominee.get(nominee_id)
+
+    def open_nomination_by(self, game_number: str, nominator_id: int) -> Optional[Nomination]:
+        return self.nomination_index(game_number).by_nominator.get(nominator_id)
+
+    def forget_nominations(self, game_number: str):
+        self.nomination_indexes.pop(game_number, None)
+
+    def get_tally(self, game_number: str, nom: Nomination) -> VoteTally:
+        # kept up to date by journal_vote, and dropped whenever players or settings change
+        tallies = self.tallies.setdefault(game_number, {})
+        tally = tallies.get(nom.message)
+        if tally is None:
+            tally = VoteTally(self.town_squares[game_number], nom)
+            if nom.message is not None and not nom.finished:
+                tallies[nom.message] = tally
+        return tally
+
+    def forget_tallies(self, game_number: str):
+        self.tallies.pop(game_number, None)
+
+    def get_nom_thread(self, game_number: str) -> Optional[nextcord.Thread]:
+        thread_id = self.town_squares[game_number].nomination_thread
+        thread = self.nom_threads.get(game_number)
+        if thread is None or thread.id != thread_id:
+            thread = self.helper.Guild.get_thread(thread_id) if thread_id is not None else None
+            if thread is None:
+                return None
+            self.nom_threads[game_number] = thread
+        return thread
+
+    def get_log_thread(self, game_number: str) -> Optional[nextcord.Thread]:
+        if game_number not in self.town_squares:
+            return None
+        thread_id = self.town_squares[game_number].log_thread
+        thread = self.log_threads.get(game_number)
+        if thread is None or thread.id != thread_id:
+            thread = self.helper.Guild.get_thread(thread_id) if thread_id is not None else None
+            if thread is None:
+                return None
+            self.log_threads[game_number] = thread
+        return thread
+
+    def get_nom_message(self, game_number: str, nom: Nomination) -> Optional[nextcord.PartialMessage]:
+        # a partial message can be edited without fetching it first
+        message = self.nom_messages.get(nom.message)
+        if message is None:
+            thread = self.get_nom_thread(game_number)
+            if thread is None:
+                thread_id = self.town_squares[game_number].nomination_thread
+                if thread_id is None:
+                    return None
+                # not cached, e.g. archived or after a restart - the message can still be addressed by id
+                thread = self.bot.get_partial_messageable(thread_id, type=nextcord.ChannelType.public_thread)
+            message = thread.get_partial_message(nom.message)
+            self.nom_messages[nom.message] = message
+        return message
+
+    async def report_missing_nom_message(self, game_number: str, nom: Nomination):
+        logging.error(f"Missing message for nomination of {nom.nominee.alias} in game {game_number}")
+        await self.log(game_number, f"{self.st_mention(game_number)} Could not find the nomination message for the "
+                                    f"nomination of {nom.nominee.alias} to update it. Please close the "
+                                    f"nomination to prevent this happening again.")
+
+    def st_mention(self, game_number: str) -> str:
+        # the role may have been deleted or renamed, the log line is still worth writing
+        st_role = self.helper.get_st_role(game_number)
+        return st_role.mention if st_role is not None else "ST"
+
+    def forget_thread(self, thread_id: int):
+        for game_number in [game for game, thread in self.nom_threads.items() if thread.id == thread_id]:
+            del self.nom_threads[game_number]
+        for game_number in [game for game, thread in self.log_threads.items() if thread.id == thread_id]:
+            del self.log_threads[game_number]
+        for message_id in [m for m, message in self.nom_messages.items() if message.channel.id == thread_id]:
+            del self.nom_messages[message_id]
+
+    @commands.Cog.listener()
+    async def on_thread_update(self, before: nextcord.Thread, after: nextcord.Thread):
+        if after.archived:
+            self.forget_thread(after.id)
+
+    @commands.Cog.listener()
+    async def on_thread_delete(self, thread: nextcord.Thread):
+        self.forget_thread(thread.id)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload: nextcord.RawMessageDeleteEvent):
+        self.nom_messages.pop(payload.message_id, None)
+
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: nextcord.RawBulkMessageDeleteEvent):
+        for message_id in payload.message_ids:
+            self.nom_messages.pop(message_id, None)
+
+    async def get_game_participant(self, game_number: str, identifier: str) -> Union[nextcord.Member, None]:
         participants = self.town_squares[game_number].players + self.town_squares[game_number].sts
         # handle explicit mentions
         if utility.is_mention(identifier):
-            member = get(self.helper.Guild.members, id=int(identifier[2:-1]))
-            if member is not None and member.id in [p.id for p in participants]:
-                return member
+            if int(identifier[2:-1]) in [p.id for p in participants]:
+                return await self.helper.Members.fetch(int(identifier[2:-1]))
             else:
                 return None
         # check alternatives for identifying the player
-        alias_matches = self.try_get_matching_player(participants, identifier, lambda p: p.alias)
-        display_names = {p.id: get(self.helper.Guild.members, id=p.id).display_name for p in participants}
-        display_name_matches = self.try_get_matching_player(participants, identifier, lambda p: display_names[p.id])
-        usernames = {p.id: get(self.helper.Guild.members, id=p.id).name for p in participants}
-        username_matches = self.try_get_matching_player(participants, identifier, lambda p: usernames[p.id])
-        if len(alias_matches) == 1:
-            target_id = alias_matches[0]
-        elif len(alias_matches) > 1:
-            if len(set(alias_matches).intersection(set(display_name_matches))) == 1:
-                target_id = list(set(alias_matches).intersection(set(display_name_matches)))[0]
-            elif len(set(alias_matches).intersection(set(username_matches))) == 1:
-                target_id = list(set(alias_matches).intersection(set(username_matches)))[0]
-            elif len(set(display_name_matches).intersection(set(display_name_matches)).intersection(
-                    set(username_matches))) == 1:
-                target_id = list(set(display_name_matches).intersection(set(display_name_matches)).intersection(
-                    set(username_matches)))[0]
-            else:
-                return None
-        elif len(display_name_matches) == 1:
-            target_id = display_name_matches[0]
-        elif len(display_name_matches) > 1:
-            if len(set(display_name_matches).intersection(set(username_matches))) == 1:
-                target_id = list(set(display_name_matches).intersection(set(username_matches)))[0]
-            else:
-                return None
-        elif len(username_matches) == 1:
-            target_id = username_matches[0]
-        else:
+        index = self.participant_indexes.get(game_number)
+        if index is None:
+            members = await self.helper.Members.fetch_many(p.id for p in participants)
+            index = ParticipantIndex(participants, members)
+            self.participant_indexes[game_number] = index
+        target_id = index.resolve(identifier)
+        if target_id is None:
             return None
-        return get(self.helper.Guild.members, id=target_id)
+        return await self.helper.Members.fetch(target_id)
+
+    def forget_participants(self, game_number: str):
+        self.participant_indexes.pop(game_number, None)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: nextcord.Member, after: nextcord.Member):
+        if before.display_name != after.display_name or before.name != after.name:
+            for game_number in [game for game, index in self.participant_indexes.items() if after.id in index.ids]:
+                self.forget_participants(game_number)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: nextcord.User, after: nextcord.User):
+        if before.name != after.name:
+            for game_number in [game for game, index in self.participant_indexes.items() if after.id in index.ids]:
+                self.forget_participants(game_number)
+
+    def game_lock(self, game_number: str) -> asyncio.Lock:
+        # everything that changes a town square across awaits holds its game's lock, so games never wait on each other
+        lock = self.game_locks.get(game_number)
+        if lock is None:
+            lock = asyncio.Lock()
+            self.game_locks[game_number] = lock
+        return lock
+
+    # runs after the checks and argument conversion of each command - one command per game at a time
+    async def cog_before_invoke(self, ctx: commands.Context):
+        # the converted game number, as the command sees it; ctx.args starts with the cog and the context
+        game_number = ctx.args[2] if len(ctx.args) > 2 else None
+        if not isinstance(game_number, str):
+            return
+        # locks are only created for games that exist, or for a town square being set up for an existing game
+        if game_number in self.town_squares or \
+                (ctx.command.name == "SetupTownSquare" and game_number in self.helper.Index.game_channels):
+            lock = self.game_lock(game_number)
+            await lock.acquire()
+            self.command_locks[ctx.message.id] = lock
+            if game_number in self.town_squares:
+                try:
+                    # commands then use the town square without waiting for storage
+                    await self.town_squares.load(game_number)
+                except BaseException:
+                    # the command doesn't run, so cog_after_invoke wouldn't release the lock either
+                    del self.command_locks[ctx.message.id]
+                    lock.release()
+                    raise
+
+    # runs after each command, also when it failed
+    async def cog_after_invoke(self, ctx: commands.Context):
+        lock = self.command_locks.pop(ctx.message.id, None)
+        if lock is not None:
+            lock.release()
 
     # runs before each command - checks a town square exists
     async def cog_check(self, ctx: commands.Context) -> bool:
@@ -276,22 +1204,6 @@ class Townsquare(commands.Cog):
         else:
             return True
 
-    @staticmethod
-    def try_get_matching_player(player_list: List[Player], identifier: str, attribute: Callable[[Player], str]) \
-            -> List[int]:
-        matches = [p.id for p in player_list if identifier.lower() in attribute(p).lower()]
-        if len(matches) > 1:
-            matches = [p.id for p in player_list if attribute(p).lower().startswith(identifier.lower())]
-            if len(matches) < 1:
-                matches = [p.id for p in player_list if identifier in attribute(p)]
-            elif len(matches) > 1:
-                matches = [p.id for p in player_list if attribute(p).startswith(identifier)]
-                if len(matches) < 1:
-                    matches = [p.id for p in player_list if attribute(p).lower() == identifier.lower()]
-                elif len(matches) > 1:
-                    matches = [p.id for p in player_list if attribute(p) == identifier]
-        return matches
-
     @commands.command()
     async def SetupTownSquare(self, ctx: commands.Context, game_number: str, players: commands.Greedy[nextcord.Member]):
         """Creates the town square for the given game, with the given players.
@@ -319,14 +1231,15 @@ class Townsquare(commands.Cog):
                         auto_archive_duration=4320,
                         type=nextcord.ChannelType.private_thread)
                 except nextcord.HTTPException:
-                    self.town_squares.pop(game_number)
+                    self.town_squares.discard(game_number)
+                    self.update_log_thread_ids()
                     await utility.deny_command(ctx, "Failed to create logging thread.")
                     return
             for st in self.helper.get_st_role(game_number).members:
                 await log_thread.add_user(st)
             self.town_squares[game_number].log_thread = log_thread.id
             await self.log(game_number, f"Town square created: {self.town_squares[game_number]}")
-            self.update_storage()
+            self.journal_town_square(game_number)
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You are not the storyteller for this game")
@@ -344,15 +1257,16 @@ class Townsquare(commands.Cog):
             removed_players = [p for p in self.town_squares[game_number].players if p not in new_player_list]
             added_players = [p for p in new_player_list if p not in self.town_squares[game_number].players]
             self.town_squares[game_number].players = new_player_list
-            for nom in [n for n in self.town_squares[game_number].nominations if not n.finished]:
+            changed_noms = [n for n in self.town_squares[game_number].nominations if not n.finished]
+            for nom in changed_noms:
                 if nom.nominator in removed_players or nom.nominee in removed_players:
                     nom.finished = True
                 for player in removed_players:
                     nom.votes.pop(player.id)
                 for player in added_players:
                     nom.votes[player.id] = Vote(not_voted_yet)
-                await self.update_nom_message(game_number, nom)
-            self.update_storage()
+            self.journal_town_square(game_number)
+            await self.update_nom_messages(ctx, game_number, changed_noms)
             await utility.finish_processing(ctx)
             await self.log(game_number, f"{ctx.author.mention} has updated the town square: {new_player_list}")
         else:
@@ -404,12 +1318,13 @@ class Townsquare(commands.Cog):
                         await thread.add_user(substitute)
                 for nom in [n for n in self.town_squares[game_number].nominations if not n.finished]:
                     nom.votes[substitute.id] = nom.votes.pop(player.id)
-                    await self.update_nom_message(game_number, nom)
             await self.log(game_number, f"{ctx.author.mention} has substituted {player.display_name} with "
                                         f"{substitute.display_name}")
             logging.debug(f"Substituted {player} with {substitute} in game {game_number} - "
                           f"current town square: {self.town_squares[game_number]}")
-            self.update_storage()
+            self.journal_town_square(game_number)
+            if current_player is not None:
+                await self.update_nom_messages(ctx, game_number, self.town_squares[game_number].nominations)
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You are not the storyteller for this game")
@@ -433,7 +1348,6 @@ class Townsquare(commands.Cog):
                 if player in [tm.member for tm in thread_members]:
                     await thread.add_user(substitute)
             logging.debug(f"Substituted {player} with {substitute} in game {game_number}")
-            self.update_storage()
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You are not the storyteller for this game")
@@ -453,7 +1367,7 @@ class Townsquare(commands.Cog):
             for st in self.helper.get_st_role(game_number).members:
                 await thread.add_user(st)
             self.town_squares[game_number].nomination_thread = thread.id
-            self.update_storage()
+            self.journal_settings(game_number, "nomination_thread")
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You are not the storyteller for this game")
@@ -467,9 +1381,10 @@ class Townsquare(commands.Cog):
         game_role = self.helper.get_game_role(game_number)
         # check permission
         can_nominate = self.helper.authorize_st_command(ctx.author, game_number) or game_role in ctx.author.roles
-        nominee = self.get_game_participant(game_number, nominee_identifier)
-        nominator = self.get_game_participant(game_number, nominator_identifier) if nominator_identifier else None
-        nom_thread = get(self.helper.Guild.threads, id=self.town_squares[game_number].nomination_thread)
+        nominee = await self.get_game_participant(game_number, nominee_identifier)
+        nominator = await self.get_game_participant(game_number, nominator_identifier) \
+            if nominator_identifier else None
+        nom_thread = self.get_nom_thread(game_number)
         if not can_nominate:
             await utility.deny_command(ctx, "You must participate in the game to nominate!")
         elif not self.helper.authorize_st_command(ctx.author,
@@ -481,8 +1396,7 @@ class Townsquare(commands.Cog):
             await utility.deny_command(ctx, "The nominee must be a game participant")
         elif not nom_thread:
             await utility.deny_command(ctx, "The nomination thread has not been created. Ask an ST to fix this.")
-        elif any([nominee.id == nom.nominee.id and not nom.finished for nom in
-                  self.town_squares[game_number].nominations]):
+        elif self.open_nomination(game_number, nominee.id) is not None:
             await utility.deny_command(ctx, "That player has already been nominated")
         else:
             await utility.start_processing(ctx)
@@ -502,7 +1416,7 @@ class Townsquare(commands.Cog):
             for player in self.town_squares[game_number].players:
                 votes[player.id] = Vote(not_voted_yet)
             deadline = utcnow() + datetime.timedelta(seconds=self.town_squares[game_number].default_nomination_duration)
-            nom = Nomination(converted_nominator, converted_nominee, votes, format_dt(deadline, "R"))
+            nom = Nomination(converted_nominator, converted_nominee, votes, int(deadline.timestamp()))
 
             content, embed = format_nom_message(game_role, self.town_squares[game_number], nom, self.emoji)
             nom_message = await nom_thread.send(content=content, embed=embed)
@@ -510,7 +1424,7 @@ class Townsquare(commands.Cog):
             self.town_squares[game_number].nominations.append(nom)
             logging.debug(f"Nomination created: in game {game_number}: {nom}")
             await utility.finish_processing(ctx)
-            self.update_storage()
+            self.journal_nomination(game_number, nom)
             await self.log(game_number, f"{converted_nominator.alias} has nominated {converted_nominee.alias}")
 
     @commands.command()
@@ -524,21 +1438,19 @@ class Townsquare(commands.Cog):
             return
         await utility.start_processing(ctx)
         if nominee_identifier:
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
         else:
-            nom = next((n for n in self.town_squares[game_number].nominations
-                        if n.nominator.id == ctx.author.id and not n.finished), None)
+            nom = self.open_nomination_by(game_number, ctx.author.id)
         if not nom:
             await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
             return
         if ctx.author.id == nom.nominator.id or self.helper.authorize_st_command(ctx.author, game_number):
             nom.accusation = accusation
-            self.update_storage()
+            self.journal_nomination(game_number, nom)
             await self.update_nom_message(game_number, nom)
             await utility.finish_processing(ctx)
             await self.log(game_number, f"{ctx.author} has added this accusation to the nomination of "
@@ -557,21 +1469,19 @@ class Townsquare(commands.Cog):
             return
         await utility.start_processing(ctx)
         if nominee_identifier:
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
         else:
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == ctx.author.id and not n.finished), None)
+            nom = self.open_nomination(game_number, ctx.author.id)
         if not nom:
             await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
             return
         if ctx.author.id == nom.nominee.id or self.helper.authorize_st_command(ctx.author, game_number):
             nom.defense = defense
-            self.update_storage()
+            self.journal_nomination(game_number, nom)
             await self.update_nom_message(game_number, nom)
             await utility.finish_processing(ctx)
             await self.log(game_number,
@@ -589,9 +1499,8 @@ class Townsquare(commands.Cog):
                 await utility.deny_command(ctx, "Vote threshold cannot be negative")
                 return
             self.town_squares[game_number].vote_threshold = target
-            for nom in [nom for nom in self.town_squares[game_number].nominations if not nom.finished]:
-                await self.update_nom_message(game_number, nom)
-            self.update_storage()
+            self.journal_settings(game_number, "vote_threshold")
+            await self.update_nom_messages(ctx, game_number, self.town_squares[game_number].nominations)
             await utility.finish_processing(ctx)
             await self.log(game_number, f"{ctx.author} has set the vote threshold to {target}")
 
@@ -601,25 +1510,27 @@ class Townsquare(commands.Cog):
         You must be a storyteller for this."""
         if self.helper.authorize_st_command(ctx.author, game_number):
             await utility.start_processing(ctx)
-            time = datetime.timedelta(hours=time_in_h)
-            if utcnow() + time < utcnow():
+            duration = datetime.timedelta(hours=time_in_h)
+            if duration < datetime.timedelta(0):
                 await utility.deny_command(ctx, "Deadline must be in the future")
                 return
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
             if not nom:
                 await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
                 return
-            nom.deadline = format_dt(utcnow() + time, "R")
-            self.update_storage()
+            deadline = utcnow() + duration
+            nom.deadline = int(deadline.timestamp())
+            nom.warned = False
+            nom.expired = False
+            self.journal_nomination(game_number, nom)
             await self.update_nom_message(game_number, nom)
             await utility.finish_processing(ctx)
             await self.log(game_number, f"{ctx.author} has set the deadline for the nomination of {nom.nominee.alias} "
-                                        f"to {format_dt(utcnow() + time)}")
+                                        f"to {format_dt(deadline)}")
         else:
             await utility.deny_command(ctx, "You must be the ST to use this command")
 
@@ -633,7 +1544,7 @@ class Townsquare(commands.Cog):
                 await utility.deny_command(ctx, "Deadline must be in the future")
                 return
             self.town_squares[game_number].default_nomination_duration = hours * 3600
-            self.update_storage()
+            self.journal_settings(game_number, "default_nomination_duration")
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You must be the ST to use this command")
@@ -680,13 +1591,12 @@ class Townsquare(commands.Cog):
         if game_role in ctx.author.roles:
             await utility.start_processing(ctx)
             for nominee_identifier in nominee_identifiers:
-                nominee = self.get_game_participant(game_number, nominee_identifier)
+                nominee = await self.get_game_participant(game_number, nominee_identifier)
                 if not nominee:
                     await utility.dm_user(ctx.author,
                                           f"Could not clearly identify any player from {nominee_identifier}")
                     continue
-                nom = next((n for n in self.town_squares[game_number].nominations if
-                            n.nominee.id == nominee.id and not n.finished), None)
+                nom = self.open_nomination(game_number, nominee.id)
                 if not nom:
                     await utility.dm_user(ctx.author, f"No relevant nomination found for nominee {nominee_identifier}")
                     continue
@@ -695,10 +1605,10 @@ class Townsquare(commands.Cog):
                                                       f"cannot be changed.")
                     continue
                 nom.votes[voter.id] = Vote(vote)
+                self.journal_vote(game_number, nom, voter.id)
                 await self.update_nom_message(game_number, nom)
                 await self.log(game_number,
                                f"{ctx.author} has set their vote on the nomination of {nom.nominee.alias} to {vote}")
-            self.update_storage()
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You must be a player to vote. "
@@ -713,12 +1623,11 @@ class Townsquare(commands.Cog):
         game_role = self.helper.get_game_role(game_number)
         if game_role in ctx.author.roles:
             await utility.start_processing(ctx)
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
             voter = next((p for p in self.town_squares[game_number].players if p.id == ctx.author.id), None)
             if not nom:
                 await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
@@ -738,7 +1647,7 @@ class Townsquare(commands.Cog):
                                                 "you cannot set your vote to it.")
                 return
             nom.private_votes[voter.id] = vote
-            self.update_storage()
+            self.journal_private_vote(game_number, nom, voter.id)
             await utility.finish_processing(ctx)
             await self.log(game_number,
                            f"{ctx.author} has set a private vote on the nomination of {nom.nominee.alias} as {vote}")
@@ -752,12 +1661,11 @@ class Townsquare(commands.Cog):
         game_role = self.helper.get_game_role(game_number)
         if game_role in ctx.author.roles:
             await utility.start_processing(ctx)
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
             voter = next((p for p in self.town_squares[game_number].players if p.id == ctx.author.id), None)
             if not nom:
                 await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
@@ -767,7 +1675,7 @@ class Townsquare(commands.Cog):
                                            "You are not included in the town square. Ask the ST to correct this.")
                 return
             private_vote = nom.private_votes.pop(voter.id, None)
-            self.update_storage()
+            self.journal_private_vote(game_number, nom, voter.id)
             await utility.finish_processing(ctx)
             if private_vote:
                 await utility.dm_user(ctx.author, f"Your private vote on the nomination of {nom.nominee.alias} "
@@ -796,23 +1704,29 @@ class Townsquare(commands.Cog):
                                            'might be exposed. If you want to do so anyway, run the command again with '
                                            '`public` added at the end')
                 return
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
             if not nom:
                 await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
                 return
+            for old_view in [v for v in self.vote_count_views if v.nom is nom]:
+                # only the latest count of a nomination stays active
+                old_view.stop()
+                self.vote_count_views.remove(old_view)
             view = CountVoteView(self, nom, ctx.author, game_number, self.emoji)
             message = await ctx.send(content="`Count as yes` and `Count as no` will lock the current player's vote in, "
                                              "update the public nomination message and proceed to the next player. "
-                                             "Any other button will not lock the vote in, allowing you to make "
-                                             "further adjustments. Click any button to begin",
+                                             "`Lock clear votes` locks in every plain yes or no at once, and every "
+                                             "player that cannot vote as no, so only the rest is left to step "
+                                             "through. Any other button will not lock the vote in, allowing you to "
+                                             "make further adjustments. Click any button to begin",
                                      view=view)
             view.message = message
             self.vote_count_views.append(view)
+            self.store_vote_counts()
             await utility.finish_processing(ctx)
         else:
             await utility.deny_command(ctx, "You must be the Storyteller to count the votes for a nomination")
@@ -824,22 +1738,22 @@ class Townsquare(commands.Cog):
         reset. You must be a storyteller for this. Note that you cannot lock a vote in this way."""
         if self.helper.authorize_st_command(ctx.author, game_number):
             await utility.start_processing(ctx)
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            voter = self.get_game_participant(game_number, voter_identifier)
+            voter = await self.get_game_participant(game_number, voter_identifier)
             if not voter:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {voter_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
             if not nom:
                 await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
                 return
             if not vote:
                 vote = not_voted_yet
             nom.votes[voter.id] = Vote(vote)
+            self.journal_vote(game_number, nom, voter.id)
             await self.update_nom_message(game_number, nom)
             await utility.finish_processing(ctx)
             await self.log(game_number, f"{ctx.author} has set the vote of {voter.name} on the nomination of "
@@ -853,18 +1767,17 @@ class Townsquare(commands.Cog):
         You must be a storyteller for this."""
         if self.helper.authorize_st_command(ctx.author, game_number):
             await utility.start_processing(ctx)
-            nominee = self.get_game_participant(game_number, nominee_identifier)
+            nominee = await self.get_game_participant(game_number, nominee_identifier)
             if not nominee:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {nominee_identifier}")
                 return
-            nom = next((n for n in self.town_squares[game_number].nominations if
-                        n.nominee.id == nominee.id and not n.finished), None)
+            nom = self.open_nomination(game_number, nominee.id)
             if not nom:
                 await utility.deny_command(ctx, f"No relevant nomination found for nominee {nominee_identifier}")
                 return
             else:
                 nom.finished = True
-                self.update_storage()
+                self.journal_nomination(game_number, nom)
                 await utility.finish_processing(ctx)
                 await self.log(game_number, f"{ctx.author} has closed the nomination of {nom.nominee.alias}")
         else:
@@ -888,7 +1801,8 @@ class Townsquare(commands.Cog):
                                            "You are not included in the town square. Ask the ST to correct this.")
                 return
             player.alias = alias
-            self.update_storage()
+            self.forget_participants(game_number)
+            self.journal_player(game_number, player)
             await self.log(game_number, f"{ctx.author.name} has set their alias to {alias}")
             await utility.finish_processing(ctx)
         elif st_role in ctx.author.roles:
@@ -899,7 +1813,8 @@ class Townsquare(commands.Cog):
                                                 "Try dropping and re-adding the grimoire")
                 return
             st.alias = alias
-            self.update_storage()
+            self.forget_participants(game_number)
+            self.journal_player(game_number, st)
             await utility.finish_processing(ctx)
             await self.log(game_number, f"{ctx.author.name} has set their alias to {alias}")
         else:
@@ -914,10 +1829,8 @@ class Townsquare(commands.Cog):
         if self.helper.authorize_st_command(ctx.author, game_number):
             await utility.start_processing(ctx)
             self.town_squares[game_number].organ_grinder = not self.town_squares[game_number].organ_grinder
-            self.update_storage()
-            for nom in self.town_squares[game_number].nominations:
-                if not nom.finished:
-                    await self.update_nom_message(game_number, nom)
+            self.journal_settings(game_number, "organ_grinder")
+            await self.update_nom_messages(ctx, game_number, self.town_squares[game_number].nominations)
             await utility.finish_processing(ctx)
             await utility.dm_user(ctx.author,
                                   f"Organ Grinder is now "
@@ -935,7 +1848,7 @@ class Townsquare(commands.Cog):
                 await utility.deny_command(ctx, "Town square not set up yet.")
                 return
             self.town_squares[game_number].player_noms_allowed = not self.town_squares[game_number].player_noms_allowed
-            self.update_storage()
+            self.journal_settings(game_number, "player_noms_allowed")
             await utility.finish_processing(ctx)
             await utility.dm_user(ctx.author,
                                   f"Player nominations are now "
@@ -949,7 +1862,7 @@ class Townsquare(commands.Cog):
         You must be a storyteller for this."""
         if self.helper.authorize_st_command(ctx.author, game_number):
             await utility.start_processing(ctx)
-            player_user = self.get_game_participant(game_number, player_identifier)
+            player_user = await self.get_game_participant(game_number, player_identifier)
             if not player_user:
                 await utility.deny_command(ctx, f"Could not find player with identifier {player_identifier}")
                 return
@@ -958,7 +1871,8 @@ class Townsquare(commands.Cog):
                 await utility.deny_command(ctx, f"{player_user.display_name} is not included in the town square.")
                 return
             player.dead = not player.dead
-            self.update_storage()
+            self.journal_player(game_number, player)
+            await self.update_nom_messages(ctx, game_number, self.town_squares[game_number].nominations)
             await utility.finish_processing(ctx)
             await utility.dm_user(ctx.author, f"{player.alias} is now "
                                               f"{'marked as dead' if player.dead else 'marked as living'}")
@@ -973,7 +1887,7 @@ class Townsquare(commands.Cog):
         You must be a storyteller for this."""
         if self.helper.authorize_st_command(ctx.author, game_number):
             await utility.start_processing(ctx)
-            player_user = self.get_game_participant(game_number, player_identifier)
+            player_user = await self.get_game_participant(game_number, player_identifier)
             if not player_user:
                 await utility.deny_command(ctx, f"Could not clearly identify any player from {player_identifier}")
                 return
@@ -982,7 +1896,8 @@ class Townsquare(commands.Cog):
                 await utility.deny_command(ctx, f"{player_user.display_name} is not included in the town square.")
                 return
             player.can_vote = not player.can_vote
-            self.update_storage()
+            self.journal_player(game_number, player)
+            await self.update_nom_messages(ctx, game_number, self.town_squares[game_number].nominations)
             await utility.finish_processing(ctx)
             await utility.dm_user(ctx.author, f"{player.alias} can now "
                                               f"{'vote' if player.can_vote else 'not vote'}")
@@ -1000,18 +1915,28 @@ class CountVoteView(nextcord.ui.View):
     emoji: Dict[str, nextcord.PartialEmoji]
     player_list: List[Player]
     player_index: int = -1
-    message: nextcord.Message
+    message: Union[nextcord.Message, nextcord.PartialMessage]
+    last_rendered: Optional[tuple] = None
 
     def __init__(self, votes_cog: Townsquare, nom: Nomination, author: nextcord.Member,
-                 game_number: str, emoji: Dict[str, nextcord.PartialEmoji]):
-        super().__init__()
+                 game_number: str, emoji: Dict[str, nextcord.PartialEmoji], player_index: int = -1):
+        # no timeout and fixed custom_ids make this a persistent view, see Townsquare.restore_vote_counts
+        super().__init__(timeout=None)
         self.cog = votes_cog
         self.nom = nom
         self.author = author
-        self.player_list = reordered_players(self.nom, self.cog.town_squares[game_number])
         self.game_number = game_number
+        self.player_list = self.cog.get_tally(game_number, nom).seats
         self.emoji = emoji
-        self.timeout = 86400  # 24h
+        if player_index != -1:
+            self.player_index = player_index
+            self.sync_players()
+            self.set_button_emoji()
+            self.set_button_states()
+
+    def session(self) -> VoteCountSession:
+        return VoteCountSession(self.game_number, self.nom.message, self.author.id, self.message.channel.id,
+                                self.message.id, self.player_index)
 
     async def on_error(self, error: Exception, item: nextcord.ui.Item, interaction: nextcord.Interaction) -> None:
         traceback_buffer = io.StringIO()
@@ -1029,20 +1954,54 @@ class CountVoteView(nextcord.ui.View):
     async def check_initial(self):
         if self.player_index == -1:
             self.player_index = 0
-            bureaucrat = next((item for item in self.children if
-                               isinstance(item, nextcord.ui.Button) and item.custom_id == "bureaucrat"))
-            bureaucrat.emoji = self.emoji["bureaucrat"]
-            thief = next(
-                (item for item in self.children if isinstance(item, nextcord.ui.Button) and item.custom_id == "thief"))
-            thief.emoji = self.emoji["thief"]
-            mark_dead = next(
-                (item for item in self.children if isinstance(item, nextcord.ui.Button) and item.custom_id == "die"))
-            mark_dead.emoji = self.emoji["shroud"]
+            self.set_button_emoji()
+            self.cog.store_vote_counts()
             await self.update_message()
             return True
         return False
 
+    def set_button_emoji(self):
+        bureaucrat = next((item for item in self.children if
+                           isinstance(item, nextcord.ui.Button) and item.custom_id == "bureaucrat"))
+        bureaucrat.emoji = self.emoji["bureaucrat"]
+        thief = next(
+            (item for item in self.children if isinstance(item, nextcord.ui.Button) and item.custom_id == "thief"))
+        thief.emoji = self.emoji["thief"]
+        mark_dead = next(
+            (item for item in self.children if isinstance(item, nextcord.ui.Button) and item.custom_id == "die"))
+        mark_dead.emoji = self.emoji["shroud"]
+
+    def set_button_states(self):
+        # the buttons of the current player reflect what was already set for them, e.g. before a restart
+        if self.player_index >= len(self.player_list):
+            return
+        player = self.player_list[self.player_index]
+        vote = self.nom.votes[player.id]
+        next((item for item in self.children if item.custom_id == "bureaucrat")).style = \
+            nextcord.ButtonStyle.blurple if vote.bureaucrat else nextcord.ButtonStyle.grey
+        next((item for item in self.children if item.custom_id == "thief")).style = \
+            nextcord.ButtonStyle.blurple if vote.thief else nextcord.ButtonStyle.grey
+        next((item for item in self.children if item.custom_id == "die")).disabled = player.dead
+        next((item for item in self.children if item.custom_id == "deadvote")).disabled = not player.can_vote
+
+    def sync_players(self):
+        # the seats are those of the nomination's tally, which is only rebuilt when players or settings change -
+        # so this is a single comparison unless players were added, removed or substituted during the count
+        if self.game_number not in self.cog.town_squares:
+            return
+        player_list = self.cog.get_tally(self.game_number, self.nom).seats
+        if player_list is self.player_list or [p.id for p in player_list] == [p.id for p in self.player_list]:
+            self.player_list = player_list
+            return
+        if 0 <= self.player_index < len(self.player_list):
+            current_id = self.player_list[self.player_index].id
+            self.player_index = next((i for i, p in enumerate(player_list) if p.id == current_id),
+                                     next((i for i, p in enumerate(player_list) if self.nom.votes[p.id].vote not in
+                                           [confirmed_yes_vote, confirmed_no_vote]), len(player_list)))
+        self.player_list = player_list
+
     async def update_message(self):
+        self.sync_players()
         content = f"Nominator: {self.nom.nominator.alias}, Nominee: {self.nom.nominee.alias}"
         for index, player in enumerate(self.player_list):
             line = player.alias
@@ -1065,94 +2024,177 @@ class CountVoteView(nextcord.ui.View):
                     line = f"{self.emoji['thief']}{line}"
                 line = f"{clock_emoji}**{line}**"
             content += f"\n{line}"
+        rendered = (content, self.to_components())
+        if rendered == self.last_rendered:
+            return
         await self.message.edit(content=content, view=self)
+        self.last_rendered = rendered
+
+    def set_locked_vote(self, player_id: int, vote: str):
+        if self.nom.private_votes.pop(player_id, None) is not None:
+            self.cog.journal_private_vote(self.game_number, self.nom, player_id)
+        self.nom.votes[player_id].vote = vote
+        self.cog.journal_vote(self.game_number, self.nom, player_id)
 
     async def lock_vote(self, vote: str):
-        self.nom.private_votes.pop(self.player_list[self.player_index].id, None)
-        self.nom.votes[self.player_list[self.player_index].id].vote = vote
-        self.player_index += 1
-        next((item for item in self.children if item.custom_id == "bureaucrat")).style = nextcord.ButtonStyle.grey
-        next((item for item in self.children if item.custom_id == "thief")).style = nextcord.ButtonStyle.grey
-        next((item for item in self.children if item.custom_id == "die")).disabled = False
-        next((item for item in self.children if item.custom_id == "deadvote")).disabled = False
+        self.set_locked_vote(self.player_list[self.player_index].id, vote)
+        await self.proceed()
+
+    def lock_clear_votes(self) -> List[Tuple[Player, str]]:
+        # players that cannot vote are counted as no, private votes take priority over public ones
+        locked = []
+        for player in self.player_list[self.player_index:]:
+            vote = self.nom.votes[player.id].vote
+            if vote in [confirmed_yes_vote, confirmed_no_vote]:
+                continue
+            decision = classify_vote(self.nom.private_votes.get(player.id, vote)) if player.can_vote \
+                else confirmed_no_vote
+            if decision is not None:
+                self.set_locked_vote(player.id, decision)
+                locked.append((player, decision))
+        return locked
+
+    async def proceed(self):
+        # moves the clock past every vote that is locked in, which may be more than the one just locked
+        previous_index = self.player_index
+        while self.player_index < len(self.player_list) and \
+                self.nom.votes[self.player_list[self.player_index].id].vote in [confirmed_yes_vote, confirmed_no_vote]:
+            self.player_index += 1
+        if self.player_index != previous_index:
+            next((item for item in self.children if item.custom_id == "bureaucrat")).style = nextcord.ButtonStyle.grey
+            next((item for item in self.children if item.custom_id == "thief")).style = nextcord.ButtonStyle.grey
+            next((item for item in self.children if item.custom_id == "die")).disabled = False
+            next((item for item in self.children if item.custom_id == "deadvote")).disabled = False
+            self.cog.store_vote_counts()
         if self.player_index >= len(self.player_list):
             self.nom.finished = True
             self.clear_items()
             self.stop()
             if self in self.cog.vote_count_views:
                 self.cog.vote_count_views.remove(self)
+        if self.nom.finished:
+            self.cog.journal_nomination(self.game_number, self.nom)
         await self.update_message()
         await self.cog.update_nom_message(self.game_number, self.nom)
-        self.cog.update_storage()
 
     @nextcord.ui.button(label="Count as yes", custom_id="yes", style=nextcord.ButtonStyle.green, row=1)
     async def vote_yes_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
         await interaction.response.defer()
-        if await self.check_initial():
-            return
-        await self.lock_vote(confirmed_yes_vote)
+        async with self.cog.game_lock(self.game_number):
+            if await self.check_initial():
+                return
+            self.sync_players()
+            if self.player_index >= len(self.player_list):
+                return
+            player = self.player_list[self.player_index]
+            await self.lock_vote(confirmed_yes_vote)
         await self.cog.log(self.game_number,
-                           f"{self.author} locked vote of {self.player_list[self.player_index - 1].alias}"
-                           f" on the nomination of {self.nom.nominee.alias} as yes")
+                           f"{self.author} locked vote of {player.alias} on the nomination of {self.nom.nominee.alias} "
+                           f"as yes")
 
     @nextcord.ui.button(label="Count as no", custom_id="no", style=nextcord.ButtonStyle.red, row=1)
     async def vote_no_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
         await interaction.response.defer()
-        if await self.check_initial():
-            return
-        await self.lock_vote(confirmed_no_vote)
+        async with self.cog.game_lock(self.game_number):
+            if await self.check_initial():
+                return
+            self.sync_players()
+            if self.player_index >= len(self.player_list):
+                return
+            player = self.player_list[self.player_index]
+            await self.lock_vote(confirmed_no_vote)
         await self.cog.log(self.game_number,
-                           f"{self.author} locked vote of {self.player_list[self.player_index - 1].alias}"
-                           f" on the nomination of {self.nom.nominee.alias} as no")
+                           f"{self.author} locked vote of {player.alias} on the nomination of {self.nom.nominee.alias} "
+                           f"as no")
 
     @nextcord.ui.button(label="Count triple", custom_id="bureaucrat", style=nextcord.ButtonStyle.grey, row=1)
     async def bureaucrat_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
         await interaction.response.defer()
-        if await self.check_initial():
-            return
-        vote = self.nom.votes[self.player_list[self.player_index].id]
-        vote.bureaucrat = not vote.bureaucrat
-        button.style = nextcord.ButtonStyle.blurple if vote.bureaucrat else nextcord.ButtonStyle.grey
-        await self.update_message()
+        async with self.cog.game_lock(self.game_number):
+            if await self.check_initial():
+                return
+            self.sync_players()
+            if self.player_index >= len(self.player_list):
+                return
+            player_id = self.player_list[self.player_index].id
+            vote = self.nom.votes[player_id]
+            vote.bureaucrat = not vote.bureaucrat
+            # journaled like a locked vote, so a restored count shows the modifier again
+            self.cog.journal_vote(self.game_number, self.nom, player_id)
+            button.style = nextcord.ButtonStyle.blurple if vote.bureaucrat else nextcord.ButtonStyle.grey
+            await self.update_message()
 
     @nextcord.ui.button(label="Count negative", custom_id="thief", style=nextcord.ButtonStyle.grey, row=1)
     async def thief_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
         await interaction.response.defer()
-        if await self.check_initial():
-            return
-        vote = self.nom.votes[self.player_list[self.player_index].id]
-        vote.thief = not vote.thief
-        button.style = nextcord.ButtonStyle.blurple if vote.thief else nextcord.ButtonStyle.grey
-        await self.update_message()
+        async with self.cog.game_lock(self.game_number):
+            if await self.check_initial():
+                return
+            self.sync_players()
+            if self.player_index >= len(self.player_list):
+                return
+            player_id = self.player_list[self.player_index].id
+            vote = self.nom.votes[player_id]
+            vote.thief = not vote.thief
+            # journaled like a locked vote, so a restored count shows the modifier again
+            self.cog.journal_vote(self.game_number, self.nom, player_id)
+            button.style = nextcord.ButtonStyle.blurple if vote.thief else nextcord.ButtonStyle.grey
+            await self.update_message()
 
     @nextcord.ui.button(label="Should be dead", custom_id="die", style=nextcord.ButtonStyle.grey, row=2)
     async def die_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
         await interaction.response.defer()
-        if await self.check_initial():
-            return
-        self.player_list[self.player_index].dead = True
-        button.disabled = True
-        self.cog.update_storage()
-        await self.update_message()
+        async with self.cog.game_lock(self.game_number):
+            if await self.check_initial():
+                return
+            self.sync_players()
+            if self.player_index >= len(self.player_list):
+                return
+            self.player_list[self.player_index].dead = True
+            button.disabled = True
+            self.cog.journal_player(self.game_number, self.player_list[self.player_index])
+            await self.update_message()
 
     @nextcord.ui.button(label="Loses vote", custom_id="deadvote", style=nextcord.ButtonStyle.grey, row=2)
     async def deadvote_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
         await interaction.response.defer()
-        if await self.check_initial():
-            return
-        self.player_list[self.player_index].can_vote = False
-        button.disabled = True
-        self.cog.update_storage()
-        await self.update_message()
+        async with self.cog.game_lock(self.game_number):
+            if await self.check_initial():
+                return
+            self.sync_players()
+            if self.player_index >= len(self.player_list):
+                return
+            self.player_list[self.player_index].can_vote = False
+            button.disabled = True
+            self.cog.journal_player(self.game_number, self.player_list[self.player_index])
+            await self.update_message()
+
+    @nextcord.ui.button(label="Lock clear votes", custom_id="lock_clear", style=nextcord.ButtonStyle.blurple, row=2)
+    async def lock_clear_callback(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
+        await interaction.response.defer()
+        async with self.cog.game_lock(self.game_number):
+            await self.check_initial()
+            self.sync_players()
+            locked = self.lock_clear_votes()
+            if not locked:
+                await utility.dm_user(interaction.user, "There are no clear votes left to lock in")
+                return
+            await self.proceed()
+        votes = ", ".join(f"{player.alias} as {'yes' if vote == confirmed_yes_vote else 'no'}"
+                          for player, vote in locked)
+        await self.cog.log(self.game_number,
+                           f"{self.author} locked the votes of {votes} on the nomination of {self.nom.nominee.alias}")
 
     @nextcord.ui.button(label="Ping current player", custom_id="ping_current", style=nextcord.ButtonStyle.red, row=3)
     async def ping_current(self, button: nextcord.ui.Button, interaction: nextcord.Interaction):
         await interaction.response.defer()
         if await self.check_initial():
             return
-        player = get(self.cog.helper.Guild.members, id=self.player_list[self.player_index].id)
-        nom_thread = get(self.cog.helper.get_game_channel(self.game_number).threads,
-                         id=self.cog.town_squares[self.game_number].nomination_thread)
+        player = await self.cog.helper.Members.fetch(self.player_list[self.player_index].id)
+        if player is None:
+            await utility.dm_user(interaction.user, "The current player is no longer on the server")
+            return
+        nom_thread = self.cog.get_nom_thread(self.game_number)
         await nom_thread.send(f"The clock in the nomination on {self.nom.nominee.alias} is on {player.mention}. "
                               f"Please vote at next opportunity.")
 
@@ -1161,16 +2203,21 @@ class CountVoteView(nextcord.ui.View):
         await interaction.response.defer()
         if await self.check_initial():
             return
-        nom_thread = get(self.cog.helper.get_game_channel(self.game_number).threads,
-                         id=self.cog.town_squares[self.game_number].nomination_thread)
-        for player in [player for player in self.player_list if
-                       player.can_vote and self.nom.votes[player.id].vote == not_voted_yet]:
-            player_member = get(self.cog.helper.Guild.members, id=player.id)
+        nom_thread = self.cog.get_nom_thread(self.game_number)
+        remaining = [player for player in self.player_list if
+                     player.can_vote and self.nom.votes[player.id].vote == not_voted_yet]
+        members = await self.cog.helper.Members.fetch_many(player.id for player in remaining)
+        for player in remaining:
+            player_member = members[player.id]
+            if player_member is None:
+                continue
             await nom_thread.send(f"{player_member.mention}, reminder: you have not yet voted on the nomination of "
                                   f"{self.nom.nominee.alias}")
 
 
 async def setup(bot: commands.Bot):
-    cog = Townsquare(bot, utility.Helper(bot))
+    cog = Townsquare(bot, utility.get_helper(bot))
     await cog.load_emoji()
+    await cog.restore_vote_counts()
+    cog.start_deadline_timer()
     bot.add_cog(cog)
@@ -112,4 +112,4 @@ class Users(commands.Cog):
 
 
 def setup(bot: commands.Bot):
-    bot.add_cog(Users(bot, utility.Helper(bot)))
+    bot.add_cog(Users(bot, utility.get_helper(bot)))
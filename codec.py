@@ -0,0 +1,114 @@
+import dataclasses
+import json
+import typing
+from typing import Any, Dict, Type
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Encoders and decoders are generated as plain python source from each model's type hints the first time it is
+# used, so converting a model is just nested dict/list comprehensions instead of reflection on every value.
+
+def serializable(cls):
+    """Gives a dataclass to_dict and from_dict methods, replacing dataclasses_json's."""
+
+    def to_dict(self) -> dict:
+        compile_codec(cls)
+        return cls.to_dict(self)
+
+    def from_dict(_, data: dict):
+        compile_codec(cls)
+        return cls.from_dict(data)
+
+    cls.to_dict = to_dict
+    cls.from_dict = classmethod(from_dict)
+    return cls
+
+
+def is_serializable(tp) -> bool:
+    return isinstance(tp, type) and dataclasses.is_dataclass(tp) and hasattr(tp, "to_dict")
+
+
+def encode_expression(tp, value: str, depth: int, namespace: Dict[str, Any]) -> str:
+    origin = typing.get_origin(tp)
+    args = typing.get_args(tp)
+    if origin is typing.Union:
+        inner = [arg for arg in args if arg is not type(None)]
+        if len(inner) == 1:
+            expression = encode_expression(inner[0], value, depth, namespace)
+            return value if expression == value else f"(None if {value} is None else {expression})"
+        return value
+    if origin is list:
+        item = f"v{depth}"
+        expression = encode_expression(args[0], item, depth + 1, namespace) if args else item
+        return f"list({value})" if expression == item else f"[{expression} for {item} in {value}]"
+    if origin is dict:
+        key, item = f"k{depth}", f"v{depth}"
+        expression = encode_expression(args[1], item, depth + 1, namespace) if args else item
+        return f"dict({value})" if expression == item else f"{{{key}: {expression} for {key}, {item} in {value}.items()}}"
+    if is_serializable(tp):
+        return f"{value}.to_dict()"
+    return value
+
+
+def decode_expression(tp, value: str, depth: int, namespace: Dict[str, Any]) -> str:
+    origin = typing.get_origin(tp)
+    args = typing.get_args(tp)
+    if origin is typing.Union:
+        inner = [arg for arg in args if arg is not type(None)]
+        if len(inner) == 1:
+            expression = decode_expression(inner[0], value, depth, namespace)
+            return value if expression == value else f"(None if {value} is None else {expression})"
+        return value
+    if origin is list:
+        item = f"v{depth}"
+        expression = decode_expression(args[0], item, depth + 1, namespace) if args else item
+        return f"list({value})" if expression == item else f"[{expression} for {item} in {value}]"
+    if origin is dict:
+        key, item = f"k{depth}", f"v{depth}"
+        # JSON object keys are always strings
+        key_expression = f"int({key})" if args and args[0] is int else key
+        expression = decode_expression(args[1], item, depth + 1, namespace) if args else item
+        return f"{{{key_expression}: {expression} for {key}, {item} in {value}.items()}}"
+    if is_serializable(tp):
+        namespace[f"_{tp.__name__}"] = tp
+        return f"_{tp.__name__}.from_dict({value})"
+    return value
+
+
+def compile_codec(cls: Type):
+    hints = typing.get_type_hints(cls)
+    namespace = {"_cls": cls}
+    encode_lines = ["def to_dict(self):", "    return {"]
+    decode_lines = ["def from_dict(_, data):", "    kwargs = {}"]
+    for f in dataclasses.fields(cls):
+        encoded = encode_expression(hints[f.name], f"self.{f.name}", 0, namespace)
+        encode_lines.append(f"        {f.name!r}: {encoded},")
+        decoded = decode_expression(hints[f.name], f"data[{f.name!r}]", 0, namespace)
+        if f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING:
+            decode_lines.append(f"    kwargs[{f.name!r}] = {decoded}")
+        else:
+            # stored data from before a field was added simply lacks it
+            decode_lines.append(f"    if {f.name!r} in data:")
+            decode_lines.append(f"        kwargs[{f.name!r}] = {decoded}")
+    encode_lines.append("    }")
+    decode_lines.append("    return _cls(**kwargs)")
+    exec("\n".join(encode_lines + decode_lines), namespace)
+    cls.to_dict = namespace["to_dict"]
+    cls.from_dict = classmethod(namespace["from_dict"])
+
+
+def dumps(data: Any, indent: bool = False) -> str:
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(data, option=option).decode("utf-8")
+    return json.dumps(data, indent=2 if indent else None)
+
+
+def loads(text: str) -> Any:
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
@@ -0,0 +1,298 @@
+import os
+import sqlite3
+from typing import Any, Callable, List, Optional
+
+import codec
+from persistence import Store, WriteJob
+
+# the stores registered by the cogs get their own tables, indexed for the lookups the cogs do;
+# anything else ends up in the documents table
+Schema = """
+CREATE TABLE IF NOT EXISTS town_squares (
+    game TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS nominations (
+    game TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    message INTEGER,
+    nominator INTEGER NOT NULL,
+    nominee INTEGER NOT NULL,
+    finished INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (game, position)
+);
+CREATE INDEX IF NOT EXISTS nominations_by_nominee ON nominations (game, nominee);
+CREATE INDEX IF NOT EXISTS nominations_by_message ON nominations (message);
+CREATE TABLE IF NOT EXISTS votes (
+    game TEXT NOT NULL,
+    nomination INTEGER NOT NULL,
+    player INTEGER NOT NULL,
+    vote TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (game, nomination, player)
+);
+CREATE TABLE IF NOT EXISTS queues (
+    channel_type TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queue_entries (
+    channel_type TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    st INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (channel_type, position)
+);
+CREATE INDEX IF NOT EXISTS queue_entries_by_st ON queue_entries (st);
+CREATE TABLE IF NOT EXISTS reserved_games (
+    announced INTEGER NOT NULL,
+    owner INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (announced, owner)
+);
+CREATE INDEX IF NOT EXISTS reserved_games_by_date ON reserved_games (announced, date);
+CREATE TABLE IF NOT EXISTS reminders (
+    position INTEGER PRIMARY KEY,
+    time INTEGER NOT NULL,
+    channel INTEGER NOT NULL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS reminders_by_time ON reminders (time);
+CREATE INDEX IF NOT EXISTS reminders_by_channel ON reminders (channel, time);
+CREATE TABLE IF NOT EXISTS thread_archival (
+    channel TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    store TEXT NOT NULL,
+    record TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS journal_by_store ON journal (store, id);
+CREATE TABLE IF NOT EXISTS documents (
+    store TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (store, key)
+);
+"""
+
+
+def sync_rows(db: sqlite3.Connection, table: str, key_length: int, rows: List[tuple], condition: str = "",
+              args: tuple = ()):
+    # rows hold every column in table order, primary key first, and replace the rows that match the condition.
+    # Only rows that changed are upserted and only rows that are gone are deleted, the others aren't touched
+    cursor = db.execute(f"SELECT * FROM {table}" + (f" WHERE {condition}" if condition else ""), args)
+    columns = [column[0] for column in cursor.description]
+    existing = {row[:key_length]: row for row in cursor}
+    keys = columns[:key_length]
+    changed = [row for row in rows if existing.get(row[:key_length]) != row]
+    if changed:
+        db.executemany(f"INSERT INTO {table} VALUES ({', '.join('?' * len(columns))}) "
+                       f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET "
+                       f"{', '.join(f'{column} = excluded.{column}' for column in columns[key_length:])}", changed)
+    current = {row[:key_length] for row in rows}
+    gone = [key for key in existing if key not in current]
+    if gone:
+        db.executemany(f"DELETE FROM {table} WHERE {' AND '.join(f'{key} = ?' for key in keys)}", gone)
+
+
+def write_town_square(db: sqlite3.Connection, game: str, data: Optional[dict]):
+    town_squares, nominations, votes = [], [], []
+    if data is not None:
+        town_square = {key: value for key, value in data.items() if key != "nominations"}
+        town_squares.append((game, codec.dumps(town_square)))
+        for position, nom in enumerate(data.get("nominations", [])):
+            nomination = {key: value for key, value in nom.items() if key != "votes"}
+            nominations.append((game, position, nom["message"], nom["nominator"]["id"], nom["nominee"]["id"],
+                                nom["finished"], codec.dumps(nomination)))
+            votes += [(game, position, int(player), vote["vote"], codec.dumps(vote))
+                      for player, vote in nom["votes"].items()]
+    sync_rows(db, "votes", 3, votes, "game = ?", (game,))
+    sync_rows(db, "nominations", 2, nominations, "game = ?", (game,))
+    sync_rows(db, "town_squares", 1, town_squares, "game = ?", (game,))
+
+
+def read_town_square(db: sqlite3.Connection, game: str) -> Optional[dict]:
+    row = db.execute("SELECT data FROM town_squares WHERE game = ?", (game,)).fetchone()
+    if row is None:
+        return None
+    town_square = codec.loads(row[0])
+    nominations = [codec.loads(data) for data, in
+                   db.execute("SELECT data FROM nominations WHERE game = ? ORDER BY position", (game,))]
+    for nom in nominations:
+        nom["votes"] = {}
+    for position, player, data in db.execute("SELECT nomination, player, data FROM votes WHERE game = ?", (game,)):
+        nominations[position]["votes"][player] = codec.loads(data)
+    town_square["nominations"] = nominations
+    return town_square
+
+
+def write_queues(db: sqlite3.Connection, data: dict):
+    queues, entries = [], []
+    for channel_type, queue in data.items():
+        queues.append((channel_type, codec.dumps({key: value for key, value in queue.items() if key != "entries"})))
+        entries += [(channel_type, position, entry["st"], codec.dumps(entry))
+                    for position, entry in enumerate(queue["entries"])]
+    sync_rows(db, "queue_entries", 2, entries)
+    sync_rows(db, "queues", 1, queues)
+
+
+def read_queues(db: sqlite3.Connection) -> dict:
+    queues = {}
+    for channel_type, data in db.execute("SELECT channel_type, data FROM queues"):
+        queues[channel_type] = codec.loads(data)
+        queues[channel_type]["entries"] = [
+            codec.loads(entry) for entry, in
+            db.execute("SELECT data FROM queue_entries WHERE channel_type = ? ORDER BY position", (channel_type,))]
+    return queues
+
+
+def write_reserved(db: sqlite3.Connection, data: dict):
+    sync_rows(db, "reserved_games", 2, [(announced, int(owner), entry["date"], codec.dumps(entry))
+                                        for announced, section in enumerate(["entries", "announced"])
+                                        for owner, entry in data[section].items()])
+
+
+def read_reserved(db: sqlite3.Connection) -> dict:
+    reserved = {"entries": {}, "announced": {}}
+    for announced, owner, data in db.execute("SELECT announced, owner, data FROM reserved_games ORDER BY date"):
+        reserved["announced" if announced else "entries"][owner] = codec.loads(data)
+    return reserved
+
+
+def reserved_until(db: sqlite3.Connection, cutoff: str) -> list:
+    # dates are ISO formatted, so they compare as strings
+    return [codec.loads(data) for data, in db.execute(
+        "SELECT data FROM reserved_games WHERE announced = 0 AND date <= ? ORDER BY date", (cutoff,))]
+
+
+def write_reminders(db: sqlite3.Connection, data: list):
+    # the position only tells identical reminders apart, so a reminder keeps its row while others come and go
+    positions = {}
+    for position, text in db.execute("SELECT position, data FROM reminders"):
+        positions.setdefault(text, []).append(position)
+    next_position = max((position for kept in positions.values() for position in kept), default=-1) + 1
+    rows = []
+    for reminder in data:
+        text = codec.dumps(reminder)
+        if positions.get(text):
+            position = positions[text].pop()
+        else:
+            position = next_position
+            next_position += 1
+        rows.append((position, reminder["time"], reminder["channel"], text))
+    sync_rows(db, "reminders", 1, rows)
+
+
+def read_reminders(db: sqlite3.Connection) -> list:
+    return [codec.loads(data) for data, in db.execute("SELECT data FROM reminders ORDER BY time, position")]
+
+
+def reminders_for_channel(db: sqlite3.Connection, channel: int) -> list:
+    return [codec.loads(data) for data, in
+            db.execute("SELECT data FROM reminders WHERE channel = ? ORDER BY time", (channel,))]
+
+
+def write_thread_archival(db: sqlite3.Connection, data: dict):
+    sync_rows(db, "thread_archival", 1, [(str(channel), codec.dumps(threads)) for channel, threads in data.items()])
+
+
+def read_thread_archival(db: sqlite3.Connection) -> dict:
+    return {channel: codec.loads(data) for channel, data in db.execute("SELECT channel, data FROM thread_archival")}
+
+
+DocumentTables = {"queue": (read_queues, write_queues),
+                  "reserved": (read_reserved, write_reserved),
+                  "reminders": (read_reminders, write_reminders),
+                  "thread_archival": (read_thread_archival, write_thread_archival)}
+ShardTables = {"townsquares": (read_town_square, write_town_square)}
+# indexed queries the cogs use instead of searching their own state, see Persistence.lookup
+Lookups = {("reminders", "by_channel"): reminders_for_channel,
+           ("reserved", "until"): reserved_until}
+
+
+class SqliteBackend:
+    """Keeps all stores in a single SQLite database in WAL mode. Only ever used from the persistence worker thread.
+    Each write job is one transaction, and only the rows that changed are written."""
+    path: str
+    db: Optional[sqlite3.Connection]
+    lookups = Lookups
+
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+
+    def connection(self) -> sqlite3.Connection:
+        if self.db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(Schema)
+        return self.db
+
+    def is_empty(self) -> bool:
+        db = self.connection()
+        tables = [name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+        return all(db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone() is None for table in tables
+                   if not table.startswith("sqlite_"))
+
+    def read_document(self, store: Store) -> Optional[Any]:
+        db = self.connection()
+        if store.name in DocumentTables:
+            return DocumentTables[store.name][0](db)
+        row = db.execute("SELECT data FROM documents WHERE store = ? AND key = ''", (store.name,)).fetchone()
+        return None if row is None else codec.loads(row[0])
+
+    def list_keys(self, store: Store) -> List[str]:
+        db = self.connection()
+        if store.name in ShardTables:
+            return [game for game, in db.execute("SELECT game FROM town_squares")]
+        return [key for key, in db.execute("SELECT key FROM documents WHERE store = ?", (store.name,))]
+
+    def read_shard(self, store: Store, key: str) -> Optional[Any]:
+        db = self.connection()
+        if store.name in ShardTables:
+            return ShardTables[store.name][0](db, key)
+        row = db.execute("SELECT data FROM documents WHERE store = ? AND key = ?", (store.name, key)).fetchone()
+        return None if row is None else codec.loads(row[0])
+
+    def lookup(self, function: Callable, *args) -> List[Any]:
+        return function(self.connection(), *args)
+
+    def read_journal(self, store: Store) -> List[str]:
+        return [record for record, in
+                self.connection().execute("SELECT record FROM journal WHERE store = ? ORDER BY id", (store.name,))]
+
+    def append(self, store: Store, line: str):
+        db = self.connection()
+        with db:
+            db.execute("INSERT INTO journal (store, record) VALUES (?, ?)", (store.name, line))
+
+    def write(self, jobs: List[WriteJob]):
+        db = self.connection()
+        with db:
+            for job in jobs:
+                for key, data in job.writes:
+                    self.write_entry(db, job.store, key, data)
+                if job.clear_journal and job.store.journal is not None:
+                    db.execute("DELETE FROM journal WHERE store = ?", (job.store.name,))
+
+    def write_entry(self, db: sqlite3.Connection, store: Store, key: Optional[str], data: Optional[Any]):
+        if key is None and store.name in DocumentTables:
+            DocumentTables[store.name][1](db, data)
+        elif key is not None and store.name in ShardTables:
+            ShardTables[store.name][1](db, key, data)
+        elif data is None:
+            db.execute("DELETE FROM documents WHERE store = ? AND key = ?", (store.name, key or ""))
+        else:
+            db.execute("INSERT OR REPLACE INTO documents VALUES (?, ?, ?)", (store.name, key or "", codec.dumps(data)))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
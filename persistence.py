@@ -0,0 +1,257 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+import codec
+
+DefaultWriteDelay = 5.0  # seconds
+
+
+def read_json(path: str) -> Optional[Any]:
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return codec.loads(f.read())
+
+
+def read_lines(path: str) -> List[str]:
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return f.readlines()
+
+
+def list_shards(directory: str) -> List[str]:
+    os.makedirs(directory, exist_ok=True)
+    return [file[:-5] for file in os.listdir(directory) if file.endswith(".json")]
+
+
+def write_json(path: str, data: Optional[Any]):
+    # None removes the file, anything else is written to a temporary file first so a crash never leaves half a file
+    if data is None:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    temp_file = path + ".tmp"
+    with open(temp_file, 'w') as f:
+        f.write(codec.dumps(data, indent=True))
+    os.replace(temp_file, path)
+
+
+def append_line(path: str, line: str):
+    with open(path, 'a') as f:
+        f.write(line)
+
+
+@dataclass
+class Store:
+    name: str
+    path: str
+    serialize: Callable
+    sharded: bool = False
+    journal: Optional[str] = None
+    dirty: Set[Optional[str]] = field(default_factory=set)
+
+
+@dataclass
+class WriteJob:
+    store: Store
+    keys: Set[Optional[str]]
+    writes: List[Tuple[Optional[str], Optional[Any]]]  # (shard key or None for documents, content or None to remove)
+    clear_journal: bool = False
+
+
+class JsonBackend:
+    """Keeps documents as single JSON files and sharded stores as one JSON file per key."""
+    lookups = {}  # there is nothing to index, the cogs search their own state
+
+    def read_document(self, store: Store) -> Optional[Any]:
+        return read_json(store.path)
+
+    def list_keys(self, store: Store) -> List[str]:
+        return list_shards(store.path)
+
+    def read_shard(self, store: Store, key: str) -> Optional[Any]:
+        return read_json(os.path.join(store.path, key + ".json"))
+
+    def read_journal(self, store: Store) -> List[str]:
+        return read_lines(store.journal)
+
+    def append(self, store: Store, line: str):
+        append_line(store.journal, line)
+
+    def write(self, jobs: List[WriteJob]):
+        for job in jobs:
+            for key, data in job.writes:
+                write_json(job.store.path if key is None else os.path.join(job.store.path, key + ".json"), data)
+            if job.clear_journal and job.store.journal is not None:
+                # every journaled change up to this point is contained in the shards that were just written
+                open(job.store.journal, 'w').close()
+
+    def close(self):
+        pass
+
+
+def copy_stores(source, target, stores: List[Store]) -> Dict[str, int]:
+    counts = {}
+    for store in stores:
+        if store.sharded:
+            keys = source.list_keys(store)
+            writes = [(key, source.read_shard(store, key)) for key in keys]
+        else:
+            data = source.read_document(store)
+            writes = [] if data is None else [(None, data)]
+        target.write([WriteJob(store, set(), writes, clear_journal=True)])
+        if store.journal is not None:
+            for line in source.read_journal(store):
+                target.append(store, line)
+        counts[store.name] = len(writes)
+    return counts
+
+
+class Persistence:
+    """Collects storage changes from all cogs and writes them on a worker thread.
+    Cogs mark their state dirty instead of writing it themselves; everything marked within the write delay
+    is written together. Reads also go through the worker, so they always see preceding writes.
+    Where the data ends up is decided by the backend - JSON files by default, see database.py for SQLite."""
+    write_delay: float
+    backend: Any
+    executor: ThreadPoolExecutor
+    stores: Dict[str, Store]
+    flush_handle: Optional[asyncio.TimerHandle]
+
+    def __init__(self, write_delay: float = DefaultWriteDelay, backend=None):
+        self.write_delay = write_delay
+        self.backend = backend if backend is not None else JsonBackend()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+        self.stores = {}
+        self.flush_handle = None
+
+    def register_document(self, name: str, path: str, serialize: Callable[[], Any]):
+        """Registers a store kept in a single JSON file. serialize returns the full content."""
+        self.stores[name] = Store(name, path, serialize)
+
+    def register_shards(self, name: str, directory: str, serialize: Callable[[str], Optional[Any]],
+                        journal: Optional[str] = None):
+        """Registers a store with one JSON file per key. serialize returns the content for a key, or None if the key
+        was removed. If a journal is given, it is emptied whenever all changed shards have been written."""
+        self.stores[name] = Store(name, directory, serialize, sharded=True, journal=journal)
+
+    def unregister(self, name: str):
+        store = self.stores.pop(name, None)
+        if store is not None and store.dirty:
+            self.executor.submit(self.backend.write, [self.collect(store)])
+
+    def run(self, function: Callable, *args):
+        """Runs a storage function on the worker thread and waits for it. Only meant for loading at startup."""
+        return self.executor.submit(function, *args).result()
+
+    def load(self, path: str) -> Optional[Any]:
+        """Reads a JSON file regardless of backend, e.g. storage left behind by older versions."""
+        return self.run(read_json, path)
+
+    def load_document(self, name: str) -> Optional[Any]:
+        return self.run(self.backend.read_document, self.stores[name])
+
+    def shard_keys(self, name: str) -> List[str]:
+        return self.run(self.backend.list_keys, self.stores[name])
+
+    def load_shard(self, name: str, key: str) -> Optional[Any]:
+        return self.run(self.backend.read_shard, self.stores[name], key)
+
+    async def run_async(self, function: Callable, *args):
+        """Runs a storage function on the worker thread without blocking the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def lookup(self, name: str, lookup: str, *args) -> Optional[List[Any]]:
+        """Runs one of the backend's indexed lookups on a store and returns the matching entries as stored, or None
+        if the backend has no such lookup and the cog has to search its own state. Pending changes are written first,
+        so the result matches what the cog has in memory."""
+        function = self.backend.lookups.get((name, lookup))
+        if function is None:
+            return None
+        await self.flush()
+        return await self.run_async(self.backend.lookup, function, *args)
+
+    async def fetch_shard(self, name: str, key: str) -> Optional[Any]:
+        """Reads a shard without blocking the event loop. Like every read, it runs after the writes queued before
+        it."""
+        return await self.run_async(self.backend.read_shard, self.stores[name], key)
+
+    def write_shard(self, name: str, key: str, data: Any):
+        self.run(self.backend.write, [WriteJob(self.stores[name], {key}, [(key, data)])])
+
+    def read_journal(self, name: str) -> List[str]:
+        return self.run(self.backend.read_journal, self.stores[name])
+
+    async def import_from(self, source) -> Dict[str, int]:
+        """Copies every registered store from another backend into this one, replacing pending changes.
+        Returns the number of documents or shards copied per store."""
+        for store in self.stores.values():
+            store.dirty.clear()
+        counts = await self.run_async(copy_stores, source, self.backend, list(self.stores.values()))
+        # changes made meanwhile are from state the import replaces
+        for store in self.stores.values():
+            store.dirty.clear()
+        return counts
+
+    def mark_dirty(self, name: str, key: Optional[str] = None):
+        self.stores[name].dirty.add(key)
+        self.schedule_flush()
+
+    def append(self, name: str, record: dict):
+        """Appends a record to the store's journal without waiting for the write."""
+        self.executor.submit(self.backend.append, self.stores[name], codec.dumps(record) + "\n")
+
+    def append_to_file(self, path: str, line: str):
+        """Appends a line to a plain file outside any store without waiting for the write."""
+        self.executor.submit(append_line, path, line)
+
+    def schedule_flush(self):
+        if self.flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # not running inside the bot, e.g. a maintenance script - nothing to coalesce with
+            self.run(self.backend.write, self.collect_all())
+            return
+        self.flush_handle = loop.call_later(self.write_delay, lambda: asyncio.ensure_future(self.flush()))
+
+    def collect(self, store: Store) -> WriteJob:
+        # serializing happens here, on the event loop, so the worker only ever sees a consistent copy
+        keys = set(store.dirty)
+        store.dirty.clear()
+        if store.sharded:
+            writes = [(key, store.serialize(key)) for key in keys]
+        else:
+            writes = [(None, store.serialize())]
+        return WriteJob(store, keys, writes, clear_journal=True)
+
+    def collect_all(self) -> List[WriteJob]:
+        return [self.collect(store) for store in self.stores.values() if store.dirty]
+
+    async def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        jobs = self.collect_all()
+        if not jobs:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.backend.write, jobs)
+            logging.debug(f"Wrote {sum(len(job.writes) for job in jobs)} storage entries")
+        except Exception as e:
+            logging.exception(f"Failed to write storage, will retry: {e}")
+            for job in jobs:
+                if job.store.name in self.stores:
+                    self.stores[job.store.name].dirty.update(job.keys)
+            self.schedule_flush()
+
+    async def close(self):
+        await self.flush()
+        self.executor.submit(self.backend.close)
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,217 @@
+import asyncio
+import dataclasses
+import datetime
+import heapq
+import itertools
+import logging
+import random
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+import persistence
+from codec import serializable
+
+# what a job does about runs it missed while the bot was down
+MissedRunOnce = "once"  # run once right away, however many runs were missed
+MissedSkip = "skip"  # wait for the next regular run
+
+
+class HeapTimer:
+    """Calls a coroutine for each scheduled key once its time (seconds since the epoch) has come.
+    A single task sleeps until the earliest entry, so nothing is polled. Scheduling or rescheduling a key is
+    O(log n); the entries it replaces stay in the heap and are skipped when they come up."""
+    callback: Callable[[Hashable], Awaitable]
+    heap: List[Tuple[float, int, Hashable]]
+    due: Dict[Hashable, float]
+    wakeup: asyncio.Event
+    task: Optional[asyncio.Task]
+
+    def __init__(self, callback: Callable[[Hashable], Awaitable]):
+        self.callback = callback
+        self.heap = []
+        self.due = {}
+        self.counter = itertools.count()  # keeps keys, which need not be comparable, out of heap comparisons
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def schedule(self, key: Hashable, when: float):
+        if self.due.get(key) == when:
+            return
+        self.due[key] = when
+        heapq.heappush(self.heap, (when, next(self.counter), key))
+        if self.heap[0][2] == key:
+            self.wakeup.set()
+
+    def cancel(self, key: Hashable):
+        self.due.pop(key, None)
+
+    def cancel_where(self, predicate: Callable[[Hashable], bool]):
+        for key in [key for key in self.due if predicate(key)]:
+            del self.due[key]
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+    def pop_due(self, now: float) -> List[Hashable]:
+        keys = []
+        while self.heap and self.heap[0][0] <= now:
+            when, _, key = heapq.heappop(self.heap)
+            if self.due.get(key) == when:
+                del self.due[key]
+                keys.append(key)
+        return keys
+
+    def next_time(self) -> Optional[float]:
+        # drops replaced and cancelled entries from the top of the heap
+        while self.heap and self.due.get(self.heap[0][2]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            next_time = self.next_time()
+            delay = None if next_time is None else next_time - time.time()
+            if delay is None or delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            for key in self.pop_due(time.time()):
+                try:
+                    await self.callback(key)
+                except Exception as e:
+                    logging.exception(f"Timer callback for {key} failed: {e}")
+
+
+@serializable
+@dataclass
+class Job:
+    """A recurring job. The schedule comes from the cog registering it, the rest is kept across restarts."""
+    name: str
+    interval: float = 0  # seconds between runs, for jobs not tied to a time of day
+    daily_at: str = ""  # "HH:MM" in UTC
+    missed: str = MissedRunOnce
+    jitter: float = 0  # up to this many seconds are added to every run time
+    next_run: float = 0
+    last_run: float = 0
+    runs: int = 0
+    failures: int = 0
+    last_duration: float = 0
+    total_duration: float = 0
+
+    def next_after(self, now: float) -> float:
+        if self.daily_at:
+            hour, minute = [int(part) for part in self.daily_at.split(":")]
+            today = datetime.datetime.fromtimestamp(now, datetime.timezone.utc)
+            slot = today.replace(hour=hour, minute=minute, second=0, microsecond=0).timestamp()
+            if slot <= now:
+                slot += 24 * 3600
+        else:
+            slot = now + self.interval
+        return slot + random.uniform(0, self.jitter)
+
+    def same_schedule(self, other: "Job") -> bool:
+        return (self.interval, self.daily_at, self.jitter) == (other.interval, other.daily_at, other.jitter)
+
+    def explain(self) -> str:
+        schedule = f"daily at {self.daily_at} UTC" if self.daily_at else f"every {self.interval / 3600:g}h"
+        average = self.total_duration / self.runs if self.runs else 0
+        return f"{self.name}: {schedule}, next <t:{int(self.next_run)}:R>, {self.runs} runs " \
+               f"({self.failures} failed), last took {self.last_duration:.1f}s, average {average:.1f}s"
+
+
+class TimerService:
+    """Runs the recurring jobs of all cogs on one HeapTimer, instead of a tasks.loop per cog.
+    Job state is stored, so a run that was due while the bot was down is caught up according to the job's missed
+    policy. Each run is its own task, so a slow job doesn't hold up the others."""
+    storage: persistence.Persistence
+    jobs: Dict[str, Job]  # includes jobs of cogs that aren't loaded, so their state survives a reload
+    callbacks: Dict[str, Callable[[], Awaitable]]
+    running: Dict[str, asyncio.Task]
+    timer: HeapTimer
+
+    def __init__(self, storage: persistence.Persistence, path: str):
+        self.storage = storage
+        self.jobs = {}
+        self.callbacks = {}
+        self.running = {}
+        self.timer = HeapTimer(self.start_job)
+        self.storage.register_document("timers", path, self.serialize)
+        json_data = self.storage.load_document("timers")
+        if json_data is not None:
+            self.jobs = {name: Job.from_dict(data) for name, data in json_data.items()}
+
+    def serialize(self) -> dict:
+        return {name: job.to_dict() for name, job in self.jobs.items()}
+
+    def update_storage(self):
+        self.storage.mark_dirty("timers")
+
+    def add_job(self, name: str, callback: Callable[[], Awaitable], interval: float = 0, daily_at: str = "",
+                missed: str = MissedRunOnce, jitter: float = 0):
+        """Runs callback every interval seconds, or every day at daily_at ("HH:MM" UTC), until remove_job."""
+        job = Job(name, interval, daily_at, missed, jitter)
+        now = time.time()
+        saved = self.jobs.get(name)
+        if saved is not None:
+            job = dataclasses.replace(saved, interval=interval, daily_at=daily_at, missed=missed, jitter=jitter)
+        if saved is None or not saved.same_schedule(job) or saved.next_run == 0:
+            job.next_run = job.next_after(now)
+        elif job.next_run <= now:
+            if missed == MissedRunOnce:
+                logging.info(f"Catching up on run of {name} missed at "
+                             f"{datetime.datetime.fromtimestamp(job.next_run, datetime.timezone.utc)}")
+                job.next_run = now
+            else:
+                job.next_run = job.next_after(now)
+        self.jobs[name] = job
+        self.callbacks[name] = callback
+        self.timer.schedule(name, job.next_run)
+        self.timer.start()
+        self.update_storage()
+
+    def remove_job(self, name: str):
+        self.callbacks.pop(name, None)
+        self.timer.cancel(name)
+        task = self.running.pop(name, None)
+        if task is not None:
+            task.cancel()
+
+    def stop(self):
+        self.timer.stop()
+        for task in self.running.values():
+            task.cancel()
+        self.running.clear()
+
+    async def start_job(self, name: str):
+        if name in self.callbacks and name not in self.running:
+            self.running[name] = asyncio.create_task(self.run_job(name))
+
+    async def run_job(self, name: str):
+        job = self.jobs[name]
+        start = time.time()
+        try:
+            await self.callbacks[name]()
+        except Exception as e:
+            job.failures += 1
+            logging.exception(f"Timer job {name} failed: {e}")
+        finally:
+            self.running.pop(name, None)
+        job.runs += 1
+        job.last_run = start
+        job.last_duration = time.time() - start
+        job.total_duration += job.last_duration
+        logging.debug(f"Timer job {name} took {job.last_duration:.2f}s")
+        if name in self.callbacks:
+            job.next_run = job.next_after(time.time())
+            self.timer.schedule(name, job.next_run)
+        self.update_storage()
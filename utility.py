@@ -1,12 +1,21 @@
+from __future__ import annotations
+import asyncio
+import datetime
+import functools
 import logging
 import os
 import re
-from typing import Union, Optional
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Union, Optional, Dict, List, Iterable, Callable
 
 import nextcord
 from dotenv import load_dotenv
 from nextcord.ext import commands
-from nextcord.utils import get
+from nextcord.utils import get, utcnow, format_dt
+
+import codec
+import persistence
 
 OwnerID = 107209184147185664
 DeveloperIDs = [224643391873482753]
@@ -69,34 +78,347 @@ def is_mention(string: str) -> bool:
     return string.startswith("<@") and string.endswith(">") and string[2:-1].isdigit()
 
 
+game_number_pattern = re.compile(r"(?<![0-9])([brx])?([0-9]+)(?![0-9])")
+
+
+def game_numbers_in(channel_name: str) -> List[str]:
+    # every number in the name, with its b/r/x prefix if it has one, so "x1-blah" yields "x1" but never "1"
+    return [(prefix or "") + digits for prefix, digits in game_number_pattern.findall(channel_name)]
+
+
+class EntityIndex:
+    """Game channels, channels and roles of the guild by game number or name, kept current from gateway events."""
+    guild: nextcord.Guild
+    category: nextcord.CategoryChannel
+    game_channels: Dict[str, List[nextcord.TextChannel]]
+    channels: Dict[str, nextcord.abc.GuildChannel]
+    roles: Dict[str, nextcord.Role]
+
+    def __init__(self, guild: nextcord.Guild, category: nextcord.CategoryChannel):
+        self.guild = guild
+        self.category = category
+        self.rebuild()
+
+    def rebuild(self):
+        self.game_channels = {}
+        for channel in self.category.text_channels:
+            self.add_game_channel(channel)
+        self.channels = {}
+        for channel in self.guild.channels:
+            self.channels.setdefault(channel.name, channel)
+        self.roles = {}
+        for role in self.guild.roles:
+            self.roles.setdefault(role.name, role)
+
+    def listeners(self) -> list:
+        return [self.on_guild_channel_create, self.on_guild_channel_update, self.on_guild_channel_delete,
+                self.on_guild_role_create, self.on_guild_role_update, self.on_guild_role_delete]
+
+    def add_game_channel(self, channel: nextcord.abc.GuildChannel):
+        if isinstance(channel, nextcord.TextChannel) and channel.category_id == self.category.id:
+            for number in set(game_numbers_in(channel.name)):
+                self.game_channels.setdefault(number, []).append(channel)
+
+    def remove_game_channel(self, channel: nextcord.abc.GuildChannel):
+        for number in set(game_numbers_in(channel.name)):
+            remaining = [c for c in self.game_channels.get(number, []) if c.id != channel.id]
+            if remaining:
+                self.game_channels[number] = remaining
+            else:
+                self.game_channels.pop(number, None)
+
+    def remove_channel_name(self, name: str, channel_id: int):
+        if name in self.channels and self.channels[name].id == channel_id:
+            # another channel may share the name
+            replacement = get(self.guild.channels, name=name)
+            if replacement is None or replacement.id == channel_id:
+                del self.channels[name]
+            else:
+                self.channels[name] = replacement
+
+    def remove_role_name(self, name: str, role_id: int):
+        if name in self.roles and self.roles[name].id == role_id:
+            replacement = get(self.guild.roles, name=name)
+            if replacement is None or replacement.id == role_id:
+                del self.roles[name]
+            else:
+                self.roles[name] = replacement
+
+    async def on_guild_channel_create(self, channel: nextcord.abc.GuildChannel):
+        if channel.guild.id == self.guild.id:
+            self.add_game_channel(channel)
+            self.channels.setdefault(channel.name, channel)
+
+    async def on_guild_channel_update(self, before: nextcord.abc.GuildChannel, after: nextcord.abc.GuildChannel):
+        if after.guild.id == self.guild.id and (before.name != after.name or before.category_id != after.category_id):
+            self.remove_game_channel(before)
+            self.add_game_channel(after)
+            self.remove_channel_name(before.name, before.id)
+            self.channels.setdefault(after.name, after)
+
+    async def on_guild_channel_delete(self, channel: nextcord.abc.GuildChannel):
+        if channel.guild.id == self.guild.id:
+            self.remove_game_channel(channel)
+            self.remove_channel_name(channel.name, channel.id)
+
+    async def on_guild_role_create(self, role: nextcord.Role):
+        if role.guild.id == self.guild.id:
+            self.roles.setdefault(role.name, role)
+
+    async def on_guild_role_update(self, before: nextcord.Role, after: nextcord.Role):
+        if after.guild.id == self.guild.id and before.name != after.name:
+            self.remove_role_name(before.name, before.id)
+            self.roles.setdefault(after.name, after)
+
+    async def on_guild_role_delete(self, role: nextcord.Role):
+        if role.guild.id == self.guild.id:
+            self.remove_role_name(role.name, role.id)
+
+
+MemberCacheSize = 1000
+MemberQueryBatchSize = 100  # most user ids discord accepts in one member chunk request
+
+
+class MemberResolver:
+    """Finds guild members by id. Members missing from the guild's cache are requested from the gateway in batches,
+    and the results - including ids that are not in the guild - are kept in a bounded LRU cache."""
+    guild: nextcord.Guild
+    fetched: OrderedDict[int, Optional[nextcord.Member]]
+
+    def __init__(self, guild: nextcord.Guild):
+        self.guild = guild
+        self.fetched = OrderedDict()
+
+    def listeners(self) -> list:
+        return [self.on_member_join, self.on_member_remove]
+
+    def get(self, user_id: int) -> Optional[nextcord.Member]:
+        """Cache-only lookup for places that can't await."""
+        member = self.guild.get_member(user_id)
+        if member is None and user_id in self.fetched:
+            self.fetched.move_to_end(user_id)
+            member = self.fetched[user_id]
+        return member
+
+    async def fetch(self, user_id: int) -> Optional[nextcord.Member]:
+        return (await self.fetch_many([user_id]))[user_id]
+
+    async def fetch_many(self, user_ids: Iterable[int]) -> Dict[int, Optional[nextcord.Member]]:
+        members = {}
+        missing = []
+        for user_id in user_ids:
+            if user_id in members:
+                continue
+            member = self.guild.get_member(user_id)
+            if member is None and user_id in self.fetched:
+                self.fetched.move_to_end(user_id)
+                member = self.fetched[user_id]
+            elif member is None:
+                missing.append(user_id)
+            members[user_id] = member
+        for start in range(0, len(missing), MemberQueryBatchSize):
+            batch = missing[start:start + MemberQueryBatchSize]
+            try:
+                found = await self.guild.query_members(user_ids=batch, limit=len(batch), cache=True)
+            except (asyncio.TimeoutError, nextcord.ClientException) as e:
+                logging.warning(f"Could not query {len(batch)} members: {e}")
+                continue
+            found_by_id = {member.id: member for member in found}
+            for user_id in batch:
+                members[user_id] = found_by_id.get(user_id)
+                self.remember(user_id, members[user_id])
+        return members
+
+    def remember(self, user_id: int, member: Optional[nextcord.Member]):
+        self.fetched[user_id] = member
+        self.fetched.move_to_end(user_id)
+        while len(self.fetched) > MemberCacheSize:
+            self.fetched.popitem(last=False)
+
+    async def on_member_join(self, member: nextcord.Member):
+        if member.guild.id == self.guild.id:
+            self.fetched.pop(member.id, None)
+
+    async def on_member_remove(self, member: nextcord.Member):
+        if member.guild.id == self.guild.id:
+            self.fetched.pop(member.id, None)
+
+
+def pack_lines(lines: List[str], limit: int = 2000) -> List[str]:
+    # joins lines into as few messages as fit within Discord's length limit, keeping their order
+    messages = []
+    for line in lines:
+        if messages and len(messages[-1]) + 1 + len(line) <= limit:
+            messages[-1] += "\n" + line
+        else:
+            messages.append(line)
+    return messages
+
+
+AuditQueueSize = 500
+AuditFlushDelay = 2.0  # seconds
+AuditLevelPrefixes = {logging.DEBUG: "[debug] ", logging.WARNING: "[warning] ", logging.ERROR: "[error] ",
+                      logging.CRITICAL: "[critical] "}
+
+
+@dataclass
+class AuditEntry:
+    time: datetime.datetime
+    level: int
+    text: str
+
+    def format(self) -> str:
+        return f"{format_dt(self.time, 'T')} {AuditLevelPrefixes.get(self.level, '')}{self.text}"[:2000]
+
+
+class AuditLog:
+    """Collects lines for the mod log channel and posts them in batches. If the channel can't keep up and the queue
+    fills, routine lines are dropped before warnings and errors, and a summary says how many were lost.
+    Optionally every line is also appended to a JSONL file."""
+    channel: Callable[[], nextcord.abc.Messageable]
+    storage: persistence.Persistence
+    sink: Optional[str]
+    entries: List[AuditEntry]
+    dropped: int
+    wake: Optional[asyncio.Event]
+    worker: Optional[asyncio.Task]
+
+    def __init__(self, channel: Callable[[], nextcord.abc.Messageable], storage: persistence.Persistence,
+                 sink: Optional[str]):
+        self.channel = channel
+        self.storage = storage
+        self.sink = sink
+        self.entries = []
+        self.dropped = 0
+        self.wake = None
+        self.worker = None
+
+    def put(self, text: str, level: int = logging.INFO):
+        entry = AuditEntry(utcnow(), level, text)
+        if self.sink is not None:
+            self.storage.append_to_file(self.sink, codec.dumps({"time": entry.time.isoformat(),
+                                                               "level": logging.getLevelName(level),
+                                                               "text": text}) + "\n")
+        if len(self.entries) >= AuditQueueSize:
+            lowest = min(range(len(self.entries)), key=lambda i: self.entries[i].level)
+            self.dropped += 1
+            if self.entries[lowest].level > level:
+                return
+            del self.entries[lowest]
+        self.entries.append(entry)
+        if self.worker is None or self.worker.done():
+            self.wake = asyncio.Event()
+            self.worker = asyncio.create_task(self.run())
+        self.wake.set()
+
+    async def run(self):
+        while True:
+            await self.wake.wait()
+            await asyncio.sleep(AuditFlushDelay)
+            self.wake.clear()
+            await self.flush()
+
+    async def flush(self):
+        entries, self.entries = self.entries, []
+        lines = [entry.format() for entry in entries]
+        if self.dropped > 0:
+            lines.append(f"{self.dropped} log lines were dropped because this channel could not keep up" +
+                         (", see the audit log file" if self.sink is not None else ""))
+            self.dropped = 0
+        messages = pack_lines(lines)
+        for i, message in enumerate(messages):
+            try:
+                await self.channel().send(message)
+            except Exception as e:
+                logging.exception(f"Failed to post to the log channel: {e}")
+                self.dropped += sum(message.count("\n") + 1 for message in messages[i:])
+                return
+
+
+@dataclass(frozen=True)
+class Config:
+    guild_id: int
+    text_games_category_id: int
+    archive_category_id: int
+    mod_role_id: int
+    log_channel_id: int
+    reserving_forum_id: int
+    storage_location: str
+    storage_write_delay: float = persistence.DefaultWriteDelay
+    storage_backend: str = "json"
+    audit_log_file: Optional[str] = None
+    nomination_render_concurrency: int = 4
+    nomination_warning_hours: float = 2
+
+
+@functools.lru_cache(maxsize=None)
+def get_config() -> Config:
+    """Reads the .env file once. Raises KeyError or ValueError if a variable is missing or malformed."""
+    load_dotenv()
+    config = Config(guild_id=int(os.environ['GUILD_ID']),
+                    text_games_category_id=int(os.environ['TEXT_GAMES_CATEGORY_ID']),
+                    archive_category_id=int(os.environ['ARCHIVE_CATEGORY_ID']),
+                    mod_role_id=int(os.environ['DOOMSAYER_ROLE_ID']),
+                    log_channel_id=int(os.environ['LOG_CHANNEL_ID']),
+                    reserving_forum_id=int(os.environ['RESERVING_FORUM_CHANNEL']),
+                    storage_location=os.environ['STORAGE_LOCATION'],
+                    storage_write_delay=float(os.environ.get('STORAGE_WRITE_DELAY', persistence.DefaultWriteDelay)),
+                    storage_backend=os.environ.get('STORAGE_BACKEND', 'json').lower(),
+                    audit_log_file=os.environ.get('AUDIT_LOG_FILE') or None,
+                    nomination_render_concurrency=int(os.environ.get('NOMINATION_RENDER_CONCURRENCY', 4)),
+                    nomination_warning_hours=float(os.environ.get('NOMINATION_WARNING_HOURS', 2)))
+    if config.storage_backend not in ['json', 'sqlite']:
+        raise ValueError(f"Unknown STORAGE_BACKEND {config.storage_backend}, expected json or sqlite")
+    return config
+
+
+def get_helper(bot: commands.Bot) -> Helper:
+    # built once when the bot is ready and shared by every cog
+    if getattr(bot, "helper", None) is None:
+        bot.helper = Helper(bot)
+    return bot.helper
+
+
 class Helper:
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, config: Optional[Config] = None):
         self.bot = bot
-        load_dotenv()
-        self.Guild = get(bot.guilds, id=int(os.environ['GUILD_ID']))
-        self.TextGamesCategory = get(self.Guild.categories, id=int(os.environ['TEXT_GAMES_CATEGORY_ID']))
-        self.ReservingForum = get(self.Guild.channels, id=int(os.environ['RESERVING_FORUM_CHANNEL']))
-        self.ArchiveCategory = get(self.Guild.categories, id=int(os.environ['ARCHIVE_CATEGORY_ID']))
-        self.ModRole = get(self.Guild.roles, id=int(os.environ['DOOMSAYER_ROLE_ID']))
-        self.LogChannel = get(self.Guild.channels, id=int(os.environ['LOG_CHANNEL_ID']))
-        self.StorageLocation = os.environ['STORAGE_LOCATION']
-        if None in [self.Guild, self.TextGamesCategory, self. ReservingForum, self.ArchiveCategory, self.ModRole,
-                    self.LogChannel]:
+        self.Config = config if config is not None else get_config()
+        self.StorageLocation = self.Config.storage_location
+        self.Persistence = bot.persistence
+        self.Timers = bot.timers
+        self.Audit = AuditLog(lambda: self.LogChannel, self.Persistence, self.Config.audit_log_file)
+        self.Index = None
+        self.Members = None
+        self.refresh()
+
+    def refresh(self):
+        """Resolves the configured guild entities again, e.g. after a reconnect replaced the guild object.
+        As all cogs share this helper, they all see the new entities."""
+        self.Guild = get(self.bot.guilds, id=self.Config.guild_id)
+        if self.Guild is None:
+            logging.error("Failed to find guild. Check .env file is correct")
+            raise EnvironmentError
+        self.TextGamesCategory = get(self.Guild.categories, id=self.Config.text_games_category_id)
+        self.ReservingForum = self.Guild.get_channel(self.Config.reserving_forum_id)
+        self.ArchiveCategory = get(self.Guild.categories, id=self.Config.archive_category_id)
+        self.ModRole = self.Guild.get_role(self.Config.mod_role_id)
+        self.LogChannel = self.Guild.get_channel(self.Config.log_channel_id)
+        if None in [self.TextGamesCategory, self.ReservingForum, self.ArchiveCategory, self.ModRole, self.LogChannel]:
             logging.error("Failed to find required discord entity. Check .env file is correct and Guild is set up")
             raise EnvironmentError
+        for service in [self.Index, self.Members]:
+            if service is not None:
+                for listener in service.listeners():
+                    self.bot.remove_listener(listener)
+        self.Index = EntityIndex(self.Guild, self.TextGamesCategory)
+        self.Members = MemberResolver(self.Guild)
+        for service in [self.Index, self.Members]:
+            for listener in service.listeners():
+                self.bot.add_listener(listener)
 
     def get_game_channel(self, number: str) -> Optional[nextcord.TextChannel]:
-        if number.isdigit():  # no letters in the number
-            # ensure that number occurs without being preceded by b, r, x or another digit
-            # (so "1" doesn't find the x1 or 11 channel)
-            # or followed by another digit (so "1" doesn't find the 10 channel)
-            pattern = fr"(?<![0-9brx]){re.escape(number)}(?![0-9])"
-        else:
-            # ensure that number occurs without being immediately followed by another digit
-            # (so "x1" doesn't find the x10 channel)
-            pattern = fr"{re.escape(number)}(?![0-9])"
-        matching_channels = [channel for channel in self.TextGamesCategory.text_channels
-                             if re.search(pattern, channel.name) is not None]
+        # channels are indexed by every game number in their name, so "1" doesn't find the x1, 11 or 10 channel
+        matching_channels = self.Index.game_channels.get(number, [])
         if len(matching_channels) == 1:
             return matching_channels[0]
         if len(matching_channels) > 1:
@@ -119,35 +441,35 @@ class Helper:
         else:
             # b-games also follow this format
             name = "kibitz-game-" + number
-        channel = get(self.Guild.channels, name=name)
+        channel = self.Index.channels.get(name)
         if channel is None:
             logging.warning(f"Could not find kibitz channel for game {number}")
         return channel
 
     def get_game_role(self, number: str) -> Optional[nextcord.Role]:
         name = "game" + number
-        role = get(self.Guild.roles, name=name)
+        role = self.Index.roles.get(name)
         if role is None:
             logging.warning(f"Could not find game role for game {number}")
         return role
 
     def get_st_role(self, number: str) -> Optional[nextcord.Role]:
         name = "st" + number
-        role = get(self.Guild.roles, name=name)
+        role = self.Index.roles.get(name)
         if role is None:
             logging.warning(f"Could not find ST role for game {number}")
         return role
 
     def get_kibitz_role(self, number: str) -> Optional[nextcord.Role]:
         name = "kibitz" + number
-        role = get(self.Guild.roles, name=name)
+        role = self.Index.roles.get(name)
         if role is None:
             logging.warning(f"Could not find kibitz role for game {number}")
         return role
 
     def authorize_st_command(self, author: Union[nextcord.Member, nextcord.User], game_number: str):
         if isinstance(author, nextcord.User):
-            member = get(self.Guild.members, id=author.id)
+            member = self.Members.get(author.id)
             if member is None:
                 logging.warning("Non guild member attempting to use ST command")
                 return False
@@ -159,12 +481,13 @@ class Helper:
 
     def authorize_mod_command(self, author: Union[nextcord.Member, nextcord.User]):
         if isinstance(author, nextcord.User):
-            member = get(self.Guild.members, id=author.id)
+            member = self.Members.get(author.id)
             if member is None:
                 logging.warning("Non guild member attempting to use mod command")
                 return False
             return (self.ModRole in member.roles) or (author.id == OwnerID)
         return (self.ModRole in author.roles) or (author.id == OwnerID)
 
-    async def log(self, log_string: str):
-        await self.LogChannel.send(log_string)
\ No newline at end of file
+    async def log(self, log_string: str, level: int = logging.INFO):
+        # queued, see AuditLog
+        self.Audit.put(log_string, level)
\ No newline at end of file